@@ -1,6 +1,7 @@
 from pathlib import Path
 import os
 import dj_database_url
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 
 
@@ -36,6 +37,17 @@ STRIPE_SUCCESS_URL = os.getenv('STRIPE_SUCCESS_URL')  # URL after successful pay
 STRIPE_CANCEL_URL = os.getenv('STRIPE_CANCEL_URL')  # URL after canceled payment
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET", "")  # Webhook signing secret
 
+# Shared client (shop/payments.py): bounded waits on Stripe, a few retries,
+# and an optional API base to point at the stub server (manage.py stripe_stub)
+STRIPE_CONNECT_TIMEOUT = float(os.getenv("STRIPE_CONNECT_TIMEOUT", "3"))
+STRIPE_READ_TIMEOUT = float(os.getenv("STRIPE_READ_TIMEOUT", "10"))
+STRIPE_MAX_RETRIES = int(os.getenv("STRIPE_MAX_RETRIES", "2"))
+STRIPE_API_BASE = os.getenv("STRIPE_API_BASE", "")
+
+# Minutes a checkout holds its stock; also the Stripe session's expiry, so
+# between 30 and 1440 (shop/stock.py)
+SHOP_STOCK_HOLD_MINUTES = int(os.getenv("SHOP_STOCK_HOLD_MINUTES", "35"))
+
 # -------------------------------
 # APPLICATIONS
 # -------------------------------
@@ -89,6 +101,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'shop.context_processors.cart_count',
             ],
         },
     },
@@ -100,12 +113,51 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # DATABASE (PostgreSQL)
 # -------------------------------
 
+# Falls back to a local SQLite file when DATABASE_URL is unset (local runs, tests)
 DATABASES = {
     "default": dj_database_url.config(
-        default=os.environ.get("DATABASE_URL")
+        default=os.environ.get("DATABASE_URL") or f"sqlite:///{BASE_DIR / 'db.sqlite3'}"
     )
 }
 
+# -------------------------------
+# CACHE
+# -------------------------------
+# Redis when REDIS_URL is set, otherwise a file cache on local disk. The
+# file cache is only shared by workers on one instance, so it's for local
+# development: on Render the web service and the workers run on separate
+# instances and must share one cache, or a change made by a worker (the
+# cart cleared after payment, a catalog bump) never reaches the web
+# service's cart counts, cached sessions or catalog version.
+if os.getenv("RENDER") and not os.getenv("REDIS_URL"):
+    raise ImproperlyConfigured("REDIS_URL must point at the shared Redis on Render (see render.yaml).")
+
+if os.getenv("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.getenv("REDIS_URL"),
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": os.getenv("CACHE_DIR", "/tmp/piffystudio-cache"),
+        }
+    }
+
+# Sessions are read from the cache and only fall back to the DB on a miss
+SESSION_ENGINE = "django.contrib.sessions.backends.cached_db"
+
+# Catalog cache (shop/cache.py): per-worker LRU size and shared-tier timeout
+SHOP_CATALOG_LRU_SIZE = int(os.getenv("SHOP_CATALOG_LRU_SIZE", "512"))
+SHOP_CATALOG_CACHE_TIMEOUT = int(os.getenv("SHOP_CATALOG_CACHE_TIMEOUT", str(60 * 60)))
+
+# Anonymous full-page cache; the commit prefix drops old HTML after a deploy
+PAGE_CACHE_TIMEOUT = int(os.getenv("PAGE_CACHE_TIMEOUT", str(60 * 10)))
+PAGE_CACHE_PREFIX = os.getenv("RENDER_GIT_COMMIT", "")[:12]
+
 # -------------------------------
 # EMAIL CONFIGURATION (Gmail SMTP)
 # -------------------------------
@@ -156,6 +208,11 @@ STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / "media"
 
+# Optional front-server offload for shop/media.py: an nginx internal location
+# prefix for X-Accel-Redirect, or X-Sendfile for Apache/lighttpd
+MEDIA_ACCEL_REDIRECT = os.getenv("MEDIA_ACCEL_REDIRECT", "")
+MEDIA_SENDFILE = os.getenv("MEDIA_SENDFILE", "False") == "True"
+
 # -------------------------------
 # DEFAULT PK
 # -------------------------------
@@ -1,8 +1,9 @@
 # config/urls.py
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from django.conf import settings
-from django.conf.urls.static import static
+
+from shop.media import serve_media
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -15,5 +16,7 @@ urlpatterns = [
     path('accounts/', include('accounts.urls')),  # Accounts section
 ]
 
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+# Uploaded media in every environment; see shop/media.py for caching/offload
+urlpatterns += [
+    re_path(rf"^{settings.MEDIA_URL.lstrip('/')}(?P<path>.*)$", serve_media, name='media'),
+]
@@ -1,5 +1,9 @@
 from django.shortcuts import render
 
+from shop.cache import anonymous_page_cache
+
+
+@anonymous_page_cache
 def home(request):
     return render(request, 'pages/home.html')
 
@@ -1,11 +1,17 @@
 from django.shortcuts import render
 
+from shop.cache import anonymous_page_cache
+
+
+@anonymous_page_cache
 def installations(request):
     return render(request, 'portfolio/installations.html')
 
+@anonymous_page_cache
 def digital(request):
     return render(request, 'portfolio/digital.html')
 
+@anonymous_page_cache
 def art(request):
     return render(request, 'portfolio/art.html')
 
@@ -0,0 +1,137 @@
+import json
+
+from django.db import transaction
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET, require_POST
+
+from .cart import cart_changed, cart_lines, get_session_cart, save_session_cart
+from .models import Cart, CartItem, Product
+
+# ===========================================================
+# JSON CART API
+# ===========================================================
+# Lines are addressed by product id for guests and users alike. Every
+# endpoint answers with the whole cart so the page can redraw from one
+# response. CSRF still applies: send the token in X-CSRFToken.
+
+
+def cart_payload(request):
+    lines, total = cart_lines(request)
+    return {
+        "lines": [
+            {
+                "product_id": line.product.id,
+                "title": line.product.title,
+                "quantity": line.quantity,
+                "unit_price": str(line.product.price),
+                "line_total": str(line.total_price),
+            }
+            for line in lines
+        ],
+        "count": sum(line.quantity for line in lines),
+        "total": str(total),
+    }
+
+
+def parse_body(request):
+    try:
+        return json.loads(request.body or b"{}")
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def parse_changes(data):
+    """{product_id: quantity} from {"lines": [{"product_id": .., "quantity": ..}]}, or None."""
+    if not isinstance(data, dict) or not isinstance(data.get("lines"), list):
+        return None
+    changes = {}
+    for line in data["lines"]:
+        try:
+            product_id = int(line["product_id"])
+            quantity = int(line["quantity"])
+        except (KeyError, TypeError, ValueError):
+            return None
+        if quantity < 0:
+            return None
+        changes[product_id] = quantity
+    return changes
+
+
+def apply_changes(request, changes):
+    """Set each product's quantity (0 removes it) in one transaction."""
+    wanted = {pid for pid, qty in changes.items() if qty > 0}
+    known = set(Product.objects.filter(pk__in=wanted).values_list("pk", flat=True)) if wanted else set()
+    unknown = sorted(wanted - known)
+    if unknown:
+        return unknown
+
+    if request.user.is_authenticated:
+        with transaction.atomic():
+            cart, _ = Cart.objects.get_or_create(user=request.user)
+            removed = [pid for pid, qty in changes.items() if qty == 0]
+            if removed:
+                CartItem.objects.filter(cart=cart, product_id__in=removed).delete()
+            if wanted:
+                # One upsert for every remaining line
+                CartItem.objects.bulk_create(
+                    [CartItem(cart=cart, product_id=pid, quantity=changes[pid]) for pid in wanted],
+                    update_conflicts=True,
+                    unique_fields=["cart", "product"],
+                    update_fields=["quantity"],
+                )
+            cart_changed(request.user)
+        return []
+
+    cart = get_session_cart(request)
+    for pid, qty in changes.items():
+        if qty:
+            cart[str(pid)] = qty
+        else:
+            cart.pop(str(pid), None)
+    save_session_cart(request, cart)
+    return []
+
+
+@require_GET
+def cart_detail(request):
+    return JsonResponse(cart_payload(request))
+
+
+@require_POST
+def cart_add(request):
+    """{"product_id": 3, "quantity": 1} adds to whatever is already in the cart."""
+    data = parse_body(request)
+    try:
+        product_id = int(data["product_id"])
+        quantity = int(data.get("quantity", 1))
+    except (KeyError, TypeError, ValueError):
+        return JsonResponse({"error": "Expected product_id and an optional quantity."}, status=400)
+    if quantity < 1:
+        return JsonResponse({"error": "Quantity must be at least 1."}, status=400)
+    if not Product.objects.filter(pk=product_id).exists():
+        return JsonResponse({"error": "Unknown product.", "product_ids": [product_id]}, status=404)
+
+    if request.user.is_authenticated:
+        cart, _ = Cart.objects.get_or_create(user=request.user)
+        CartItem.objects.add(cart.id, product_id, quantity)
+        cart_changed(request.user)
+    else:
+        cart = get_session_cart(request)
+        cart[str(product_id)] = cart.get(str(product_id), 0) + quantity
+        save_session_cart(request, cart)
+
+    return JsonResponse(cart_payload(request))
+
+
+@require_POST
+def cart_batch(request):
+    """{"lines": [{"product_id": 3, "quantity": 2}, ...]} sets quantities; 0 removes."""
+    changes = parse_changes(parse_body(request))
+    if changes is None:
+        return JsonResponse({"error": "Expected lines of product_id and quantity >= 0."}, status=400)
+
+    unknown = apply_changes(request, changes)
+    if unknown:
+        return JsonResponse({"error": "Unknown products.", "product_ids": unknown}, status=404)
+
+    return JsonResponse(cart_payload(request))
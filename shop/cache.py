@@ -0,0 +1,211 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+
+# ============================
+# CATALOG CACHE
+# ============================
+# Two tiers: a small per-worker LRU in front of the shared Django cache.
+# Every key carries the current catalog version, which lives in the shared
+# cache. Saving or deleting a catalog model bumps the version (see
+# shop/signals.py), so every worker starts missing on old keys and nobody
+# has to broadcast an invalidation. Old entries just age out.
+#
+# Each worker re-reads the version at most every VERSION_TTL seconds, so a
+# local hit costs no network round trip; other workers see a bump within
+# that window (the bumping worker at once). Entries carry their absolute
+# expiry, so a local copy never outlives the timeout it was set with.
+
+VERSION_KEY = "shop:catalog:version"
+VERSION_TTL = 1.0
+
+MISSING = object()
+
+
+class CatalogCache:
+    def __init__(self, alias="default", max_entries=512, timeout=60 * 60, version_ttl=VERSION_TTL):
+        self.alias = alias
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.version_ttl = version_ttl
+        self._local = OrderedDict()
+        self._version = None
+        self._version_checked = 0.0
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def reset_stats(self):
+        self.stats = {"local_hits": 0, "shared_hits": 0, "misses": 0, "bumps": 0}
+
+    # ---------- versioning ----------
+
+    def version(self):
+        now = time.monotonic()
+        if self._version is None or now - self._version_checked >= self.version_ttl:
+            self._remember_version(self._load_version())
+        return self._version
+
+    def _load_version(self):
+        version = self.shared.get(VERSION_KEY)
+        if version is None:
+            # Seed from the clock so an evicted counter never rewinds onto old keys
+            self.shared.add(VERSION_KEY, int(time.time() * 1000), timeout=None)
+            version = self.shared.get(VERSION_KEY)
+        return version
+
+    def _remember_version(self, version):
+        self._version = version
+        self._version_checked = time.monotonic()
+
+    def bump(self):
+        self.stats["bumps"] += 1
+        try:
+            version = self.shared.incr(VERSION_KEY)
+        except ValueError:
+            self._load_version()
+            version = self.shared.incr(VERSION_KEY)
+        with self._lock:
+            self._local.clear()
+        self._remember_version(version)
+
+    # ---------- lookups ----------
+
+    def key(self, name):
+        # "e": entries are (expires_at, value); older plain values never match
+        return f"shop:catalog:e:{self.version()}:{name}"
+
+    def get(self, name, default=None):
+        key = self.key(name)
+
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.time():
+                    self._local.move_to_end(key)
+                    self.stats["local_hits"] += 1
+                    return value
+                del self._local[key]
+
+        entry = self.shared.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return default
+
+        self.stats["shared_hits"] += 1
+        self._remember(key, entry)
+        return entry[1]
+
+    def set(self, name, value, timeout=None):
+        key = self.key(name)
+        timeout = timeout or self.timeout
+        # Wall-clock expiry travels with the value, so another worker's
+        # local copy expires when this one does
+        entry = (time.time() + timeout, value)
+        self.shared.set(key, entry, timeout)
+        self._remember(key, entry)
+
+    def get_or_set(self, name, builder):
+        """Return the cached value for name, calling builder() on a miss."""
+        value = self.get(name, MISSING)
+        if value is MISSING:
+            value = builder()
+            self.set(name, value)
+        return value
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._local[key] = entry
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+
+    def clear_local(self):
+        with self._lock:
+            self._local.clear()
+        self._version = None
+
+    def snapshot(self):
+        """Counters for this worker, for sizing the LRU and shared timeout."""
+        lookups = sum(self.stats[k] for k in ("local_hits", "shared_hits", "misses"))
+        hits = self.stats["local_hits"] + self.stats["shared_hits"]
+        return {
+            "pid": os.getpid(),
+            "version": self.version(),
+            "local_entries": len(self._local),
+            "local_max_entries": self.max_entries,
+            **self.stats,
+            "hit_ratio": round(hits / lookups, 3) if lookups else None,
+        }
+
+
+catalog_cache = CatalogCache(
+    max_entries=getattr(settings, "SHOP_CATALOG_LRU_SIZE", 512),
+    timeout=getattr(settings, "SHOP_CATALOG_CACHE_TIMEOUT", 60 * 60),
+)
+
+
+# ============================
+# ANONYMOUS PAGE CACHE
+# ============================
+# Whole rendered pages for logged-out visitors with nothing in their session,
+# stored through catalog_cache so catalog edits invalidate them too. CSRF
+# tokens are swapped for a marker before storing and re-issued on every hit,
+# so forms on cached pages still post.
+
+CSRF_INPUT_RE = re.compile(rb'(name="csrfmiddlewaretoken" value=")[^"]*(")')
+CSRF_MARKER = b"\x00csrf\x00"
+
+PAGE_CACHE_TIMEOUT = getattr(settings, "PAGE_CACHE_TIMEOUT", 60 * 10)
+PAGE_CACHE_PREFIX = getattr(settings, "PAGE_CACHE_PREFIX", "")
+
+
+def page_is_cacheable(request):
+    if request.method not in ("GET", "HEAD"):
+        return False
+    if request.user.is_authenticated:
+        return False
+    if request.session.get("cart"):
+        return False
+    # len() peeks at pending messages without marking them as read
+    storage = getattr(request, "_messages", None)
+    return not (storage is not None and len(storage))
+
+
+def anonymous_page_cache(view_func):
+    @wraps(view_func)
+    def wrapped_view(request, *args, **kwargs):
+        if not page_is_cacheable(request):
+            return view_func(request, *args, **kwargs)
+
+        name = f"page:{PAGE_CACHE_PREFIX}:{request.get_full_path()}"
+        cached = catalog_cache.get(name)
+        if cached is not None:
+            content, content_type = cached
+            if CSRF_MARKER in content:
+                token = get_token(request).encode()
+                content = content.replace(CSRF_MARKER, token)
+            response = HttpResponse(content, content_type=content_type)
+            response["X-Page-Cache"] = "hit"
+            return response
+
+        response = view_func(request, *args, **kwargs)
+        if response.status_code == 200 and not response.streaming and not response.cookies:
+            content = CSRF_INPUT_RE.sub(rb"\1" + CSRF_MARKER + rb"\2", response.content)
+            catalog_cache.set(name, (content, response["Content-Type"]), PAGE_CACHE_TIMEOUT)
+        response["X-Page-Cache"] = "miss"
+        return response
+
+    return wrapped_view
@@ -0,0 +1,173 @@
+from dataclasses import dataclass
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import Cart, CartItem, Product
+
+# ============================
+# SESSION CART HELPERS (GUEST SUPPORT)
+# ============================
+# The session holds {"v": 1, "lines": {"<product id>": quantity}} and nothing
+# else: titles and prices are looked up when the cart is read, so they can't
+# go stale and the session row stays small. In code a guest cart is a plain
+# {"<product id>": quantity} dict. Carts written before the version field
+# ({"<id>": {"title", "price", "quantity"}}) are still read.
+
+SESSION_CART_KEY = "cart"
+SESSION_CART_VERSION = 1
+
+
+def decode_session_cart(raw):
+    if not isinstance(raw, dict):
+        return {}
+    if raw.get("v") == SESSION_CART_VERSION:
+        lines = raw.get("lines", {})
+    else:
+        lines = {pid: line.get("quantity", 0) for pid, line in raw.items() if isinstance(line, dict)}
+
+    cart = {}
+    for pid, quantity in lines.items():
+        if str(pid).isdigit() and isinstance(quantity, int) and quantity > 0:
+            cart[str(pid)] = quantity
+    return cart
+
+
+def encode_session_cart(cart):
+    lines = {str(pid): int(qty) for pid, qty in cart.items() if int(qty) > 0}
+    return {"v": SESSION_CART_VERSION, "lines": lines} if lines else None
+
+
+def save_session_cart(request, data):
+    """Store the cart, touching the session only if the stored value changes."""
+    encoded = encode_session_cart(data)
+    if request.session.get(SESSION_CART_KEY) == encoded:
+        return
+    if encoded is None:
+        request.session.pop(SESSION_CART_KEY, None)
+    else:
+        request.session[SESSION_CART_KEY] = encoded
+
+
+def get_session_cart(request):
+    """A fresh {"<product id>": quantity} dict; safe to mutate before saving."""
+    return decode_session_cart(request.session.get(SESSION_CART_KEY))
+
+
+# ============================
+# CART LINES
+# ============================
+# Both carts come out as a list of lines with .id, .product, .quantity and
+# .total_price plus a grand total, in one query whatever the line count.
+
+@dataclass
+class SessionCartLine:
+    id: str
+    product: Product
+    quantity: int
+
+    @property
+    def total_price(self):
+        return self.product.price * self.quantity
+
+
+def user_cart_lines(user):
+    items = list(CartItem.objects.filter(cart__user=user).with_totals())
+    total = items[0].cart_total.quantize(Decimal("0.01")) if items else Decimal("0.00")
+    return items, total
+
+
+def session_cart_lines(cart):
+    """Price a session cart against current products with a single in_bulk."""
+    ids = [int(pid) for pid in cart]
+    products = Product.objects.in_bulk(ids) if ids else {}
+
+    lines = [
+        SessionCartLine(id=str(pid), product=products[pid], quantity=cart[str(pid)])
+        for pid in ids
+        if pid in products
+    ]
+    return lines, sum((line.total_price for line in lines), Decimal("0.00"))
+
+
+def cart_lines(request):
+    if request.user.is_authenticated:
+        return user_cart_lines(request.user)
+    return session_cart_lines(get_session_cart(request))
+
+
+# ============================
+# CART COUNT (NAVBAR BADGE)
+# ============================
+# Guests count their session cart. Users' counts are one SUM cached per user;
+# every code path that changes a user's cart calls cart_changed(), which
+# stamps Cart.updated_at and drops the cached value once the change commits.
+
+CART_COUNT_TIMEOUT = 60 * 60
+
+
+def cart_count_key(user_id):
+    return f"shop:cart-count:{user_id}"
+
+
+def user_cart_count(user):
+    key = cart_count_key(user.pk)
+    count = cache.get(key)
+    if count is None:
+        count = CartItem.objects.filter(cart__user=user).aggregate(n=Sum("quantity"))["n"] or 0
+        cache.set(key, count, CART_COUNT_TIMEOUT)
+    return count
+
+
+def cart_changed(user):
+    """Stamp the cart's activity time and drop the cached count after commit."""
+    user_id = user.pk
+    Cart.objects.filter(user_id=user_id).update(updated_at=timezone.now())
+    transaction.on_commit(lambda: cache.delete(cart_count_key(user_id)))
+
+
+def cart_count(request):
+    if request.user.is_authenticated:
+        return user_cart_count(request.user)
+    return sum(get_session_cart(request).values())
+
+
+# ============================
+# LOGIN MERGE
+# ============================
+
+def merge_session_cart(request, user):
+    """Fold the guest session cart into the user's cart, then clear it.
+
+    Fixed cost whatever the cart size: one product check, one fetch of the
+    user's matching lines, one bulk_create and one bulk_update.
+    """
+    wanted = {int(pid): qty for pid, qty in get_session_cart(request).items()}
+    if not wanted:
+        return
+
+    with transaction.atomic():
+        cart, _ = Cart.objects.get_or_create(user=user)
+        live = set(Product.objects.filter(pk__in=wanted).values_list("pk", flat=True))
+        existing = {
+            item.product_id: item
+            for item in CartItem.objects.select_for_update().filter(cart=cart, product_id__in=live)
+        }
+
+        to_update = []
+        for pid, item in existing.items():
+            item.quantity += wanted[pid]
+            to_update.append(item)
+        to_create = [
+            CartItem(cart=cart, product_id=pid, quantity=wanted[pid])
+            for pid in live if pid not in existing
+        ]
+
+        CartItem.objects.bulk_create(to_create)
+        CartItem.objects.bulk_update(to_update, ["quantity"])
+        cart_changed(user)
+
+    save_session_cart(request, {})
@@ -0,0 +1,8 @@
+from django.utils.functional import SimpleLazyObject
+
+from .cart import cart_count as count_cart
+
+
+def cart_count(request):
+    """{{ cart_count }} for the navbar badge; no query unless a template uses it."""
+    return {"cart_count": SimpleLazyObject(lambda: count_cart(request))}
@@ -0,0 +1,93 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+# ============================
+# ORDER EXPORT (fulfilment)
+# ============================
+# Orders are read through a server-side cursor (.iterator) CHUNK_SIZE at a
+# time, with each chunk's lines fetched by one prefetch query, and every
+# order is written out as soon as it is read. Nothing holds the whole export,
+# so memory stays flat and the first bytes go out straight away, whether
+# it's a day's orders or the full history.
+
+CHUNK_SIZE = 500
+FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+ORDER_FIELDS = [
+    "order_id", "created_at", "status", "email",
+    "shipping_name", "shipping_address1", "shipping_address2",
+    "shipping_city", "shipping_postcode", "shipping_country", "total_price",
+]
+ITEM_FIELDS = ["title", "variant_name", "quantity", "unit_price", "line_total"]
+
+
+def export_queryset(orders):
+    """Oldest first, as orders are picked and packed."""
+    return orders.prefetch_related("items").order_by("created_at", "id")
+
+
+def iter_orders(orders, chunk_size=CHUNK_SIZE):
+    """Yield (order_row, [item_row, ...]) dicts, reading chunk_size orders at a time."""
+    for order in export_queryset(orders).iterator(chunk_size=chunk_size):
+        row = {
+            "order_id": order.pk,
+            "created_at": order.created_at.isoformat(),
+            "status": order.status,
+            "email": order.email or "",
+            "shipping_name": order.shipping_name or "",
+            "shipping_address1": order.shipping_address1 or "",
+            "shipping_address2": order.shipping_address2 or "",
+            "shipping_city": order.shipping_city or "",
+            "shipping_postcode": order.shipping_postcode or "",
+            "shipping_country": order.shipping_country or "",
+            "total_price": order.total_price,
+        }
+        items = [
+            {
+                "title": item.title,
+                "variant_name": item.variant_name,
+                "quantity": item.quantity,
+                "unit_price": item.unit_price,
+                "line_total": item.line_total,
+            }
+            for item in order.items.all()
+        ]
+        yield row, items
+
+
+class Echo:
+    """File-like object whose write() hands the line back, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(orders, chunk_size=CHUNK_SIZE):
+    """A header, then one row per order line with the order's columns repeated."""
+    writer = csv.writer(Echo())
+    yield writer.writerow(ORDER_FIELDS + ITEM_FIELDS)
+    empty = [""] * len(ITEM_FIELDS)
+    for row, items in iter_orders(orders, chunk_size):
+        order_values = [row[name] for name in ORDER_FIELDS]
+        # One write per order, not per line
+        yield "".join(
+            writer.writerow(order_values + ([item[name] for name in ITEM_FIELDS] if item else empty))
+            for item in items or [None]
+        )
+
+
+def ndjson_lines(orders, chunk_size=CHUNK_SIZE):
+    """One JSON object per order, its lines nested under "items"."""
+    for row, items in iter_orders(orders, chunk_size):
+        yield json.dumps({**row, "items": items}, cls=DjangoJSONEncoder) + "\n"
+
+
+def export_lines(orders, export_format, chunk_size=CHUNK_SIZE):
+    if export_format == "ndjson":
+        return ndjson_lines(orders, chunk_size)
+    return csv_lines(orders, chunk_size)
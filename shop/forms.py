@@ -1,5 +1,9 @@
+from datetime import datetime, time, timedelta
+
 from django import forms
-from .models import Product, ProductImage, Category, ProductVariant
+from django.utils import timezone
+
+from .models import Product, ProductImage, Category, ProductVariant, Order
 
 # ============================
 # PRODUCT FORM
@@ -63,6 +67,45 @@ class VariantForm(forms.ModelForm):
         fields = ['name', 'stock', 'price_adjust']
 
 
+# ============================
+# ORDER FILTERS (manage_orders)
+# ============================
+class OrderFilterForm(forms.Form):
+    status = forms.ChoiceField(
+        choices=[("", "All statuses")] + Order.STATUS_CHOICES, required=False,
+        widget=forms.Select(attrs={"class": "form-select"}),
+    )
+    date_from = forms.DateField(
+        required=False, widget=forms.DateInput(attrs={"type": "date", "class": "form-control"}),
+    )
+    date_to = forms.DateField(
+        required=False, widget=forms.DateInput(attrs={"type": "date", "class": "form-control"}),
+    )
+    email = forms.EmailField(
+        required=False, widget=forms.EmailInput(attrs={"class": "form-control", "placeholder": "Exact email"}),
+    )
+
+    def filter(self, orders):
+        """Apply the valid filters; invalid ones are ignored (and shown as errors)."""
+        self.is_valid()
+        data = self.cleaned_data
+
+        if data.get("status"):
+            orders = orders.filter(status=data["status"])
+        # Plain created_at ranges (not __date) so the indexes still apply
+        if data.get("date_from"):
+            orders = orders.filter(created_at__gte=start_of_day(data["date_from"]))
+        if data.get("date_to"):
+            orders = orders.filter(created_at__lt=start_of_day(data["date_to"] + timedelta(days=1)))
+        if data.get("email"):
+            orders = orders.filter(email__iexact=data["email"])
+        return orders
+
+
+def start_of_day(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
 # ============================
 # CHECKOUT FORM
 # ============================
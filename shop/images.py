@@ -0,0 +1,159 @@
+import base64
+import logging
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+# ============================
+# RESPONSIVE IMAGE DERIVATIVES
+# ============================
+# Each upload gets WebP and JPEG copies at a few widths, saved under
+# products/derivatives/ and recorded on
+# ProductImage.derivatives as {"webp": {"640": "products/..."}, "jpeg": {...}}.
+# Templates turn that into srcset via shop/templatetags/shop_images.py.
+
+WIDTHS = getattr(settings, "SHOP_IMAGE_WIDTHS", (320, 640, 1024, 1600))
+
+FORMATS = {
+    "webp": {"format": "WEBP", "ext": "webp", "options": {"quality": 80, "method": 4}},
+    "jpeg": {"format": "JPEG", "ext": "jpg", "options": {"quality": 82, "optimize": True, "progressive": True}},
+}
+
+
+def target_widths(original_width):
+    """Widths smaller than the original; never upscale, always at least one."""
+    widths = [w for w in WIDTHS if w < original_width]
+    return widths or [original_width]
+
+
+def render_variant(img, width, fmt):
+    spec = FORMATS[fmt]
+    height = round(img.height * width / img.width)
+    resized = img.resize((width, height), Image.LANCZOS)
+
+    if spec["format"] == "JPEG" and resized.mode != "RGB":
+        # Flatten transparency onto white rather than black
+        background = Image.new("RGB", resized.size, (255, 255, 255))
+        if resized.mode in ("RGBA", "LA"):
+            background.paste(resized, mask=resized.getchannel("A"))
+        else:
+            background.paste(resized.convert("RGB"))
+        resized = background
+
+    buffer = BytesIO()
+    resized.save(buffer, spec["format"], **spec["options"])
+    return buffer.getvalue()
+
+
+def derivative_name(original_name, width, fmt):
+    # Originals are content-addressed, so derivative names are too: every
+    # ProductImage sharing a file shares the same derivatives.
+    stem = os.path.splitext(os.path.basename(original_name))[0]
+    return f"products/derivatives/{stem}-{width}w.{FORMATS[fmt]['ext']}"
+
+
+def generate_derivatives(product_image, force=False):
+    """Build (or reuse) the derivatives for one ProductImage. Returns the mapping."""
+    field = product_image.image
+
+    # Known width and every file already on disk: nothing to decode
+    if product_image.width and not force:
+        derivatives = {
+            fmt: {str(w): derivative_name(field.name, w, fmt) for w in target_widths(product_image.width)}
+            for fmt in FORMATS
+        }
+        if all(default_storage.exists(n) for names in derivatives.values() for n in names.values()):
+            return save_derivatives(product_image, derivatives)
+
+    try:
+        with field.storage.open(field.name, "rb") as fh:
+            img = ImageOps.exif_transpose(Image.open(fh))
+            img.load()
+    except (FileNotFoundError, UnidentifiedImageError, OSError) as exc:
+        logger.warning("Skipping derivatives for %s: %s", field.name, exc)
+        return {}
+
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+
+    derivatives = {}
+    for fmt in FORMATS:
+        derivatives[fmt] = {}
+        for width in target_widths(img.width):
+            name = derivative_name(field.name, width, fmt)
+            if force or not default_storage.exists(name):
+                default_storage.delete(name)
+                name = default_storage.save(name, ContentFile(render_variant(img, width, fmt)))
+            derivatives[fmt][str(width)] = name
+
+    return save_derivatives(product_image, derivatives)
+
+
+def save_derivatives(product_image, derivatives):
+    if product_image.derivatives != derivatives:
+        product_image.derivatives = derivatives
+        product_image.save(update_fields=["derivatives", "updated_at"])
+    return derivatives
+
+
+# ============================
+# DIMENSIONS + PLACEHOLDER
+# ============================
+# Computed once per upload so templates can reserve the right box (no layout
+# shift) and paint a dominant colour plus a ~16px blurred preview while the
+# real image loads.
+
+PLACEHOLDER_WIDTH = 16
+
+
+def dominant_color(img):
+    sample = img.convert("RGB")
+    sample.thumbnail((64, 64))
+    palette = sample.quantize(colors=5)
+    count, index = max(palette.getcolors())
+    r, g, b = palette.getpalette()[index * 3:index * 3 + 3]
+    return f"#{r:02x}{g:02x}{b:02x}"
+
+
+def placeholder_data_uri(img):
+    tiny = img.convert("RGB")
+    tiny.thumbnail((PLACEHOLDER_WIDTH, PLACEHOLDER_WIDTH * 4))
+    buffer = BytesIO()
+    tiny.save(buffer, "JPEG", quality=40)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def image_metadata(fh):
+    """width, height, dominant_color and placeholder for an open image file."""
+    img = ImageOps.exif_transpose(Image.open(fh))
+    img.load()
+    return {
+        "width": img.width,
+        "height": img.height,
+        "dominant_color": dominant_color(img),
+        "placeholder": placeholder_data_uri(img),
+    }
+
+
+def read_metadata(field):
+    """Metadata for an ImageField value, or None if the file can't be read."""
+    try:
+        if field._committed:
+            with field.storage.open(field.name, "rb") as fh:
+                return image_metadata(fh)
+        # A pending upload: read it in place and rewind so it's saved in full
+        upload = field.file
+        upload.seek(0)
+        try:
+            return image_metadata(upload)
+        finally:
+            upload.seek(0)
+    except (FileNotFoundError, UnidentifiedImageError, OSError, ValueError) as exc:
+        logger.warning("Could not read image metadata for %s: %s", field.name, exc)
+        return None
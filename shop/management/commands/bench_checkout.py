@@ -0,0 +1,75 @@
+import statistics
+import time
+
+import stripe
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from shop.payments import build_client, idempotency_key, stripe_client
+from shop.stripe_stub import StripeStub
+
+LINE_ITEMS = [
+    {
+        "price_data": {
+            "currency": "gbp",
+            "product_data": {"name": f"Print {n}", "metadata": {"product_id": str(n)}},
+            "unit_amount": 2500,
+        },
+        "quantity": 1,
+    }
+    for n in range(1, 6)
+]
+
+
+class Command(BaseCommand):
+    help = "Benchmark Checkout Session calls against the local Stripe stub."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200, help="Calls per scenario.")
+        parser.add_argument("--latency-ms", type=float, default=0, help="Stub response delay.")
+
+    def handle(self, *args, **options):
+        n = options["requests"]
+        stub = StripeStub(latency=options["latency_ms"] / 1000).start()
+        try:
+            with override_settings(STRIPE_API_BASE=stub.url, STRIPE_SECRET_KEY="sk_test_bench"):
+                session_id = self.create(stripe_client()).id
+
+                scenarios = [
+                    ("create session, shared client", lambda: self.create(stripe_client())),
+                    ("create session, client per call", lambda: self.create(build_client())),
+                    ("list line items, shared client", lambda: self.line_items(stripe_client(), session_id)),
+                ]
+
+                self.stdout.write(f"{n} calls per scenario, stub latency {options['latency_ms']:.0f} ms\n")
+                self.stdout.write(f"{'scenario':<34}{'p50 ms':>10}{'p95 ms':>10}{'calls/s':>10}")
+                for label, call in scenarios:
+                    timings = self.measure(call, n)
+                    p50 = statistics.median(timings) * 1000
+                    p95 = statistics.quantiles(timings, n=20)[-1] * 1000
+                    self.stdout.write(f"{label:<34}{p50:>10.2f}{p95:>10.2f}{n / sum(timings):>10.0f}")
+        finally:
+            stub.stop()
+
+    def create(self, client):
+        return client.v1.checkout.sessions.create(
+            params={"mode": "payment", "line_items": LINE_ITEMS},
+            options={"idempotency_key": idempotency_key("bench")},
+        )
+
+    def line_items(self, client, session_id):
+        page = client.v1.checkout.sessions.line_items.list(
+            session_id, params={"limit": 100, "expand": ["data.price.product"]},
+        )
+        return list(page.auto_paging_iter())
+
+    def measure(self, call, n):
+        timings = []
+        for _ in range(n):
+            start = time.perf_counter()
+            try:
+                call()
+            except stripe.StripeError as exc:
+                self.stderr.write(f"{type(exc).__name__}: {exc}")
+            timings.append(time.perf_counter() - start)
+        return timings
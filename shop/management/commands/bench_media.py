@@ -0,0 +1,66 @@
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory, override_settings
+from django.views.static import serve as static_serve
+
+from shop.media import serve_media
+
+HASHED_NAME = "products/ab/" + "ab" * 32 + ".jpg"
+
+
+class Command(BaseCommand):
+    help = "Benchmark shop.media.serve_media against Django's dev static() view."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size-kb", type=int, default=2048, help="Size of the test file.")
+        parser.add_argument("--requests", type=int, default=300, help="Requests per scenario.")
+
+    def handle(self, *args, **options):
+        size = options["size_kb"] * 1024
+        n = options["requests"]
+
+        with tempfile.TemporaryDirectory() as root, override_settings(MEDIA_ROOT=root):
+            fullpath = os.path.join(root, HASHED_NAME)
+            os.makedirs(os.path.dirname(fullpath))
+            with open(fullpath, "wb") as fh:
+                fh.write(os.urandom(size))
+
+            factory = RequestFactory()
+            etag = serve_media(factory.get("/"), HASHED_NAME)["ETag"]
+
+            def dev(**headers):
+                return lambda: static_serve(factory.get("/", **headers), HASHED_NAME, document_root=root)
+
+            def ours(**headers):
+                return lambda: serve_media(factory.get("/", **headers), HASHED_NAME)
+
+            scenarios = [
+                ("full GET", dev(), ours()),
+                ("revalidate (If-None-Match)", dev(HTTP_IF_NONE_MATCH=etag), ours(HTTP_IF_NONE_MATCH=etag)),
+                ("range 64 KiB", dev(HTTP_RANGE="bytes=0-65535"), ours(HTTP_RANGE="bytes=0-65535")),
+            ]
+
+            self.stdout.write(f"{options['size_kb']} KiB file, {n} requests per scenario\n")
+            self.stdout.write(f"{'scenario':<28}{'static()':>14}{'serve_media':>14}{'bytes (ours)':>16}")
+            for label, dev_view, our_view in scenarios:
+                dev_rate, _ = self.measure(dev_view, n)
+                our_rate, sent = self.measure(our_view, n)
+                self.stdout.write(f"{label:<28}{dev_rate:>10.0f} r/s{our_rate:>10.0f} r/s{sent:>16}")
+
+        self.stdout.write(
+            "\nstatic() has no ETag or Range support, so it re-sends the whole file in the "
+            "last two scenarios."
+        )
+
+    def measure(self, view, n):
+        sent = 0
+        start = time.perf_counter()
+        for _ in range(n):
+            response = view()
+            body = b"".join(response.streaming_content) if response.streaming else response.content
+            sent = len(body)
+            response.close()
+        return n / (time.perf_counter() - start), sent
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from shop.images import generate_derivatives
+from shop.models import ProductImage
+
+
+class Command(BaseCommand):
+    help = "Generate responsive WebP/JPEG derivatives for existing product images."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Rebuild every image, not just those without derivatives.",
+        )
+
+    def handle(self, *args, **options):
+        images = ProductImage.objects.order_by("pk")
+        if not options["all"]:
+            images = images.filter(derivatives={})
+
+        built = skipped = 0
+        for image in images.iterator(chunk_size=100):
+            if generate_derivatives(image, force=options["all"]):
+                built += 1
+            else:
+                skipped += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Built derivatives for {built} image(s), skipped {skipped}."))
@@ -0,0 +1,84 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from shop.cache import catalog_cache
+from shop.images import image_metadata
+from shop.models import ProductImage
+
+FIELDS = ["width", "height", "dominant_color", "placeholder"]
+BATCH_SIZE = 200
+
+
+def read_one(item):
+    """Runs in a worker process: decode one stored image, no database access."""
+    pk, name = item
+    storage = ProductImage._meta.get_field("image").storage
+    try:
+        with storage.open(name, "rb") as fh:
+            return pk, image_metadata(fh)
+    except Exception:  # any unreadable file just stays unfilled
+        return pk, None
+
+
+class Command(BaseCommand):
+    help = "Fill width, height, dominant colour and placeholder for existing product images."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count() or 1,
+            help="Worker processes decoding images (default: one per CPU).",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Recompute every image, not just those missing dimensions.",
+        )
+
+    def handle(self, *args, **options):
+        images = ProductImage.objects.order_by("pk")
+        if not options["all"]:
+            images = images.filter(width__isnull=True)
+        items = list(images.values_list("pk", "image"))
+
+        workers = max(1, options["workers"])
+        if workers == 1:
+            results = map(read_one, items)
+            pool = None
+        else:
+            # Forked workers must not inherit open database connections
+            connections.close_all()
+            pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"))
+            results = pool.map(read_one, items, chunksize=16)
+
+        done = failed = 0
+        batch = []
+        try:
+            for pk, metadata in results:
+                if metadata is None:
+                    failed += 1
+                    continue
+                batch.append(ProductImage(pk=pk, **metadata))
+                if len(batch) >= BATCH_SIZE:
+                    done += self.flush(batch)
+            done += self.flush(batch)
+        finally:
+            if pool:
+                pool.shutdown()
+
+        # bulk_update sends no signals
+        catalog_cache.bump()
+        self.stdout.write(self.style.SUCCESS(
+            f"Updated {done} image(s) with {workers} worker(s); {failed} unreadable."
+        ))
+
+    def flush(self, batch):
+        count = len(batch)
+        ProductImage.objects.bulk_update(batch, FIELDS)
+        batch.clear()
+        return count
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.exports import CHUNK_SIZE, FORMATS, export_lines
+from shop.forms import OrderFilterForm
+from shop.models import Order
+
+
+class Command(BaseCommand):
+    help = "Write orders and their lines as CSV or NDJSON, streamed (see shop/exports.py)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=sorted(FORMATS), default="csv")
+        parser.add_argument("--status", default="", help="Only orders with this status.")
+        parser.add_argument("--from", dest="date_from", default="", help="Placed on or after (YYYY-MM-DD).")
+        parser.add_argument("--to", dest="date_to", default="", help="Placed on or before (YYYY-MM-DD).")
+        parser.add_argument("--output", "-o", default="", help="File to write (default: stdout).")
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=CHUNK_SIZE,
+            help=f"Orders read per database round trip (default: {CHUNK_SIZE}).",
+        )
+
+    def handle(self, *args, **options):
+        form = OrderFilterForm({
+            "status": options["status"],
+            "date_from": options["date_from"],
+            "date_to": options["date_to"],
+        })
+        if not form.is_valid():
+            errors = "; ".join(f"{field}: {' '.join(e)}" for field, e in form.errors.items())
+            raise CommandError(f"Invalid filters: {errors}")
+
+        lines = export_lines(form.filter(Order.objects.all()), options["format"], options["chunk_size"])
+        if not options["output"]:
+            for line in lines:
+                self.stdout.write(line, ending="")
+            return
+
+        # newline="" keeps the csv module's own line endings
+        with open(options["output"], "w", encoding="utf-8", newline="") as out:
+            out.writelines(lines)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}."))
@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.webhooks import process_pending, requeue_failed
+
+
+class Command(BaseCommand):
+    help = "Handle stored Stripe webhook events (orders, cart clearing, confirmation email)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Process whatever is pending and exit instead of polling.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=2.0,
+            help="Seconds between polls when idle (default: 2).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Events picked up per poll (default: 100).",
+        )
+        parser.add_argument(
+            "--requeue-failed",
+            nargs="*",
+            metavar="EVENT_ID",
+            help="First put failed events back in the queue: the ones given, or all of them.",
+        )
+
+    def handle(self, *args, **options):
+        if options["requeue_failed"] is not None:
+            requeued = requeue_failed(options["requeue_failed"])
+            self.stdout.write(f"Requeued {requeued} failed event(s).")
+
+        while True:
+            processed, failed = process_pending(options["batch_size"])
+            if processed or failed or options["once"]:
+                self.stdout.write(f"Processed {processed} event(s); {failed} failed.")
+            if options["once"]:
+                return
+            # Failed events wait out their backoff, so only a full batch
+            # of successes means there may be more due right now
+            if processed < options["batch_size"]:
+                time.sleep(options["interval"])
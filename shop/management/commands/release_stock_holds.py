@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from shop.stock import release_expired
+
+
+class Command(BaseCommand):
+    help = "Give back stock held by checkouts that expired without being paid."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--grace-minutes",
+            type=int,
+            default=5,
+            help="Leave holds this long past expiry, for payments still in flight (default: 5).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Holds released per transaction (default: 1000).",
+        )
+
+    def handle(self, *args, **options):
+        released = release_expired(options["grace_minutes"], options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Released {released} expired hold(s)."))
@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.outbox import BATCH_SIZE, send_batch
+
+
+class Command(BaseCommand):
+    help = "Send queued emails from the outbox, one SMTP connection per batch."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Send everything that is due and exit instead of polling.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=5.0,
+            help="Seconds between polls when nothing is due (default: 5).",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=BATCH_SIZE,
+            help=f"Emails per SMTP connection (default: {BATCH_SIZE}).",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            sent, failed = send_batch(options["batch_size"])
+            if sent or failed:
+                self.stdout.write(f"Sent {sent} email(s); {failed} failed.")
+            if sent + failed < options["batch_size"]:
+                # Drained (or SMTP is down): wait before polling again
+                if options["once"]:
+                    return
+                time.sleep(options["interval"])
@@ -0,0 +1,53 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from shop.stripe_stub import StripeStub
+
+
+class Command(BaseCommand):
+    help = "Run a local stand-in for the Stripe API (set STRIPE_API_BASE to its URL)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=12111)
+        parser.add_argument(
+            "--latency-ms",
+            type=float,
+            default=0,
+            help="Delay added to every API response, to mimic the real round trip.",
+        )
+        parser.add_argument(
+            "--webhook-url",
+            default="",
+            help="Where POST /stub/sessions/<id>/complete sends the signed event, "
+                 "e.g. http://127.0.0.1:8000/shop/webhooks/stripe/.",
+        )
+        parser.add_argument(
+            "--webhook-secret",
+            default=getattr(settings, "STRIPE_WEBHOOK_SECRET", ""),
+            help="Signing secret for those events (default: STRIPE_WEBHOOK_SECRET).",
+        )
+        parser.add_argument(
+            "--auto-complete",
+            action="store_true",
+            help="Fire checkout.session.completed as soon as each session is created.",
+        )
+
+    def handle(self, *args, **options):
+        stub = StripeStub(
+            host=options["host"],
+            port=options["port"],
+            latency=options["latency_ms"] / 1000,
+            webhook_url=options["webhook_url"],
+            webhook_secret=options["webhook_secret"],
+            auto_complete=options["auto_complete"],
+            quiet=options["verbosity"] < 2,
+        )
+        self.stdout.write(f"Stripe stub listening on {stub.url}")
+        self.stdout.write(f"Run the site with STRIPE_API_BASE={stub.url} to use it.")
+        try:
+            stub.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stub.server.server_close()
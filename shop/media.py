@@ -0,0 +1,142 @@
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+# ============================
+# MEDIA SERVING
+# ============================
+# Serves MEDIA_ROOT in production. Content-hashed names (see shop/storage.py)
+# never change, so they get a year-long immutable Cache-Control and their
+# hash as a strong ETag. Single byte ranges are honoured. With
+# MEDIA_ACCEL_REDIRECT (nginx) or MEDIA_SENDFILE (Apache/lighttpd) set, the
+# worker only sends headers and the front server streams the file.
+
+HASHED_NAME_RE = re.compile(r"(?:^|/)([0-9a-f]{64}(?:-\d+w)?)\.\w+$")
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+CHUNK_SIZE = 64 * 1024
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "public, max-age=3600"
+
+
+def media_etag(path, stat):
+    match = HASHED_NAME_RE.search(path)
+    if match:
+        return f'"{match.group(1)}"'
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+
+def parse_range(header, size):
+    """(start, end) inclusive for a single satisfiable range, None to send it all, False if unsatisfiable."""
+    match = RANGE_RE.match(header or "")
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first and last and int(first) > int(last):
+        # Not a valid range at all, so the header is ignored (RFC 9110 14.2)
+        return None
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # Suffix range: the last N bytes
+        start, end = max(size - int(last), 0), size - 1
+    if start >= size:
+        return False
+    return start, end
+
+
+def iter_range(fh, start, length):
+    with fh:
+        fh.seek(start)
+        while length > 0:
+            chunk = fh.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def not_modified(request, etag, mtime):
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        return etag in [t.strip() for t in if_none_match.split(",")] or if_none_match.strip() == "*"
+    since = parse_http_date_safe(request.META.get("HTTP_IF_MODIFIED_SINCE", ""))
+    return since is not None and int(mtime) <= since
+
+
+@require_safe
+def serve_media(request, path):
+    try:
+        fullpath = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404("Invalid path")
+    if not os.path.isfile(fullpath):
+        raise Http404("File not found")
+
+    stat = os.stat(fullpath)
+    etag = media_etag(path, stat)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(stat.st_mtime),
+        "Cache-Control": IMMUTABLE if HASHED_NAME_RE.search(path) else REVALIDATE,
+        "Accept-Ranges": "bytes",
+    }
+
+    if not_modified(request, etag, stat.st_mtime):
+        response = HttpResponseNotModified()
+        for name in ("ETag", "Last-Modified", "Cache-Control"):
+            response[name] = headers[name]
+        return response
+
+    content_type, encoding = mimetypes.guess_type(fullpath)
+    content_type = content_type or "application/octet-stream"
+
+    # Hand the transfer (and any Range handling) to the front server
+    accel_prefix = getattr(settings, "MEDIA_ACCEL_REDIRECT", "")
+    if accel_prefix or getattr(settings, "MEDIA_SENDFILE", False):
+        response = HttpResponse(content_type=content_type)
+        if accel_prefix:
+            response["X-Accel-Redirect"] = accel_prefix.rstrip("/") + "/" + path.lstrip("/")
+        else:
+            response["X-Sendfile"] = fullpath
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+    byte_range = None
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if if_range is None or if_range.strip() == etag:
+        byte_range = parse_range(request.META.get("HTTP_RANGE"), stat.st_size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{stat.st_size}"
+        return response
+
+    if byte_range:
+        start, end = byte_range
+        length = end - start + 1
+        response = StreamingHttpResponse(
+            iter_range(open(fullpath, "rb"), start, length),
+            status=206,
+            content_type=content_type,
+        )
+        response["Content-Length"] = str(length)
+        response["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+    else:
+        # FileResponse lets gunicorn use wsgi.file_wrapper, i.e. sendfile(2)
+        response = FileResponse(open(fullpath, "rb"), content_type=content_type)
+
+    if encoding:
+        response["Content-Encoding"] = encoding
+    for name, value in headers.items():
+        response[name] = value
+    return response
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.26 on 2026-10-17 02:05
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+POSTGRES_FORWARD = [
+    """
+CREATE FUNCTION shop_product_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('pg_catalog.english', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('pg_catalog.english', coalesce(NEW.description, '')), 'B');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+""",
+    """
+CREATE TRIGGER shop_product_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, description ON shop_product
+    FOR EACH ROW EXECUTE FUNCTION shop_product_search_vector_update()
+""",
+    # Fire the trigger once for existing rows
+    "UPDATE shop_product SET title = title",
+    "CREATE INDEX shop_product_search_gin ON shop_product USING gin (search_vector)",
+]
+
+POSTGRES_REVERSE = [
+    "DROP INDEX IF EXISTS shop_product_search_gin",
+    "DROP TRIGGER IF EXISTS shop_product_search_vector_trigger ON shop_product",
+    "DROP FUNCTION IF EXISTS shop_product_search_vector_update()",
+]
+
+
+def forwards(apps, schema_editor):
+    # SQLite gets its FTS5 table from the post_migrate hook in shop/search.py
+    if schema_editor.connection.vendor == 'postgresql':
+        for sql in POSTGRES_FORWARD:
+            schema_editor.execute(sql, params=None)
+
+
+def backwards(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        for sql in POSTGRES_REVERSE:
+            schema_editor.execute(sql, params=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0006_product_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(forwards, backwards),
+    ]
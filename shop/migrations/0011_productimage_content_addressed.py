@@ -0,0 +1,19 @@
+# Generated by Django 4.2.26 on 2026-10-17 01:59
+
+from django.db import migrations, models
+import shop.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_productimage_metadata'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='productimage',
+            name='image',
+            field=models.ImageField(db_index=True, storage=shop.storage.product_image_storage, upload_to='products/'),
+        ),
+    ]
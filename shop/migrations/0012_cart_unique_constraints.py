@@ -0,0 +1,48 @@
+# Generated by Django 4.2.26 on 2026-10-17 02:02
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+import django.db.models.deletion
+
+
+def merge_duplicates(apps, schema_editor):
+    """Fold duplicate carts per user and duplicate lines per cart before the constraints."""
+    Cart = apps.get_model('shop', 'Cart')
+    CartItem = apps.get_model('shop', 'CartItem')
+
+    carts = Cart.objects.values('user').annotate(n=Count('id'), keep=Min('id')).filter(n__gt=1)
+    for row in carts:
+        extra = Cart.objects.filter(user=row['user']).exclude(id=row['keep'])
+        CartItem.objects.filter(cart__in=extra).update(cart_id=row['keep'])
+        extra.delete()
+
+    lines = (
+        CartItem.objects.values('cart', 'product')
+        .annotate(n=Count('id'), keep=Min('id'), total=Sum('quantity'))
+        .filter(n__gt=1)
+    )
+    for row in lines:
+        CartItem.objects.filter(id=row['keep']).update(quantity=row['total'])
+        CartItem.objects.filter(cart=row['cart'], product=row['product']).exclude(id=row['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('shop', '0011_productimage_content_addressed'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='cart',
+            name='user',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='cart', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='cartitem',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='unique_cart_product'),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 4.2.26 on 2026-10-17 02:22
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def backfill(apps, schema_editor):
+    # Existing lines only have the FK, so the product's current title and
+    # price are the best record there is. One UPDATE per column group, not a
+    # row at a time.
+    OrderItem = apps.get_model('shop', 'OrderItem')
+    Product = apps.get_model('shop', 'Product')
+    ProductVariant = apps.get_model('shop', 'ProductVariant')
+
+    product = Product.objects.filter(pk=OuterRef('product_id'))
+    variant = ProductVariant.objects.filter(pk=OuterRef('variant_id'))
+    OrderItem.objects.filter(title='', product__isnull=False).update(
+        title=Subquery(product.values('title')[:1]),
+        unit_price=Subquery(product.values('price')[:1]),
+    )
+    OrderItem.objects.filter(variant__isnull=False).update(
+        variant_name=Subquery(variant.values('name')[:1]),
+        unit_price=F('unit_price') + Coalesce(
+            Subquery(variant.values('price_adjust')[:1]), Value(0), output_field=models.DecimalField(),
+        ),
+    )
+    OrderItem.objects.update(line_total=F('unit_price') * F('quantity'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0017_stock_holds'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='line_total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='title',
+            field=models.CharField(default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='unit_price',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='orderitem',
+            name='variant_name',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='orderitem',
+            name='product',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='shop.product'),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
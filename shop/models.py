@@ -1,7 +1,16 @@
-from django.db import models
+import hashlib
+from decimal import Decimal
+
+from django.contrib.postgres.search import SearchVectorField
+from django.db import connections, models
+from django.db.models.functions import Upper
+from django.utils import timezone
 from django.utils.text import slugify
 from django.contrib.auth.models import User
 
+from .images import read_metadata
+from .storage import product_image_storage
+
 # ============================
 # CATEGORY
 # ============================
@@ -23,10 +32,58 @@ class Category(models.Model):
         return self.name
 
 
+# ============================
+# STOCK
+# ============================
+class ReservedStockMixin(models.Model):
+    """Units held by open checkouts (see shop/stock.py).
+
+    Only ever changed by conditional UPDATEs, so a full save() of a stale
+    instance (say, from the manage form) must not write it back."""
+
+    reserved = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if self.pk is not None and not self._state.adding and kwargs.get('update_fields') is None:
+            # Deferred fields stay out too, as they would in a plain save()
+            skip = self.get_deferred_fields() | {'reserved'}
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.attname not in skip and f.name not in skip
+            ]
+        super().save(*args, **kwargs)
+
+    @property
+    def available(self):
+        return max(self.stock - self.reserved, 0)
+
+
 # ============================
 # PRODUCT
 # ============================
-class Product(models.Model):
+class ProductQuerySet(models.QuerySet):
+    def for_pages(self):
+        """Without the tsvector, which only search reads (and which bloats cached objects)."""
+        return self.defer('search_vector')
+
+    def for_cards(self):
+        """Category joined in, primary image prefetched: two queries for any grid size."""
+        primary = ProductImage.objects.filter(
+            pk=models.Subquery(
+                ProductImage.objects.filter(product=models.OuterRef('product'))
+                .order_by('position', 'id')
+                .values('pk')[:1]
+            )
+        )
+        return self.for_pages().select_related('category').prefetch_related(
+            models.Prefetch('images', queryset=primary, to_attr='primary_images')
+        )
+
+
+class Product(ReservedStockMixin):
     title = models.CharField(max_length=255)
     slug = models.SlugField(unique=True, blank=True)
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products')
@@ -37,6 +94,18 @@ class Product(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Filled by a database trigger on Postgres; see shop/search.py
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = ProductQuerySet.as_manager()
+
+    class Meta:
+        # Keyset pagination walks (created_at, id) newest first, optionally per category
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='product_created_idx'),
+            models.Index(fields=['category', '-created_at', '-id'], name='product_cat_created_idx'),
+        ]
+
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.title)
@@ -45,18 +114,89 @@ class Product(models.Model):
     def __str__(self):
         return self.title
 
+    @property
+    def primary_image(self):
+        # Use the prefetched image from for_cards() when it's there
+        if hasattr(self, 'primary_images'):
+            return self.primary_images[0] if self.primary_images else None
+        return self.images.order_by('position', 'id').first()
+
+    @classmethod
+    def page_validators(cls, slug, release="", not_before=None):
+        """(etag, last_modified) for a product page from one aggregate query, or None.
+
+        release (the deploy's commit) goes into the ETag, and not_before (when
+        this release started) floors Last-Modified, so a deploy that changes
+        templates or static files never revalidates old HTML."""
+        row = (
+            cls.objects.filter(slug=slug)
+            .values('pk', 'updated_at')
+            .annotate(
+                images_at=models.Max('images__updated_at'),
+                images=models.Count('images', distinct=True),
+                variants_at=models.Max('variants__updated_at'),
+                variants=models.Count('variants', distinct=True),
+            )
+            .first()
+        )
+        if row is None:
+            return None
+
+        stamps = [row['updated_at'], row['images_at'], row['variants_at']]
+        last_modified = max(s for s in stamps + [not_before] if s is not None)
+        # Counts catch deletions, which leave no newer timestamp behind
+        raw = (
+            f"{release}:{row['pk']}:{':'.join(str(s and s.timestamp()) for s in stamps)}"
+            f":{row['images']}:{row['variants']}"
+        )
+        # Weak: the body differs per request by its CSRF token
+        return f'W/"{hashlib.md5(raw.encode()).hexdigest()}"', last_modified
+
 
 # ============================
 # PRODUCT IMAGE
 # ============================
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
-    image = models.ImageField(upload_to='products/')
+    # Content-addressed: identical uploads share one file, see shop/storage.py
+    image = models.ImageField(upload_to='products/', storage=product_image_storage, db_index=True)
     position = models.PositiveIntegerField(default=0)
+    # Resized WebP/JPEG copies by format and width; see shop/images.py
+    derivatives = models.JSONField(default=dict, blank=True, editable=False)
+    # Filled from the file on save, for layout and the loading placeholder
+    width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    dominant_color = models.CharField(max_length=7, blank=True, editable=False)
+    placeholder = models.TextField(blank=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ['position']  
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'image' in field_names:
+            instance._stored_image = values[field_names.index('image')]
+        return instance
+
+    def save(self, *args, **kwargs):
+        # Opening the file is the slow part, so only a new or different file,
+        # or missing fields, get measured; edits to position etc. don't
+        changed = 'image' not in self.get_deferred_fields() and (
+            not self.image._committed or self.image.name != getattr(self, '_stored_image', None)
+        )
+        missing = self.width is None or self.height is None or not self.dominant_color
+        if self.image and (changed or missing):
+            metadata = read_metadata(self.image)
+            if metadata:
+                for name, value in metadata.items():
+                    setattr(self, name, value)
+                if kwargs.get('update_fields') is not None:
+                    kwargs['update_fields'] = {*kwargs['update_fields'], *metadata}
+        super().save(*args, **kwargs)
+        self._stored_image = self.image.name
+
     def __str__(self):
         return f"{self.product.title} image"
 
@@ -64,11 +204,12 @@ class ProductImage(models.Model):
 # ============================
 # PRODUCT VARIANT
 # ============================
-class ProductVariant(models.Model):
+class ProductVariant(ReservedStockMixin):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='variants')
     name = models.CharField(max_length=100)  # "Small", "A3 print", "Framed", etc.
     stock = models.PositiveIntegerField(default=0)
     price_adjust = models.DecimalField(max_digits=9, decimal_places=2, default=0.00)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         unique_together = ('product', 'name')
@@ -86,8 +227,33 @@ class ProductVariant(models.Model):
 # CART
 # ============================
 class Cart(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='cart')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Last change to the cart or its lines; purge_stale_shop_state reads it
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+
+class CartItemQuerySet(models.QuerySet):
+    def with_totals(self):
+        """Product joined in; line_total and cart_total computed by the database."""
+        money = models.DecimalField(max_digits=12, decimal_places=2)
+        line_total = models.ExpressionWrapper(models.F('product__price') * models.F('quantity'), output_field=money)
+        return self.select_related('product').annotate(
+            line_total=line_total,
+            # Window over the cart: every row carries the total, no second query
+            cart_total=models.Window(models.Sum(line_total), partition_by=[models.F('cart_id')]),
+        ).order_by('pk')
+
+    def add(self, cart_id, product_id, quantity=1):
+        """Insert a line or bump its quantity in one atomic upsert statement."""
+        table = self.model._meta.db_table
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (cart_id, product_id, quantity) VALUES (%s, %s, %s) "
+                f"ON CONFLICT (cart_id, product_id) "
+                f"DO UPDATE SET quantity = {table}.quantity + excluded.quantity",
+                [cart_id, product_id, quantity],
+            )
 
 
 class CartItem(models.Model):
@@ -95,8 +261,18 @@ class CartItem(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
 
+    objects = CartItemQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product'),
+        ]
+
     @property
     def total_price(self):
+        if hasattr(self, 'line_total'):
+            # SQLite hands back unscaled decimals for computed columns
+            return self.line_total.quantize(Decimal('0.01'))
         return self.product.price * self.quantity
 
 
@@ -108,7 +284,8 @@ class CartItem(models.Model):
 # ORDER
 # ============================
 class Order(models.Model):
-    user = models.ForeignKey('auth.User', on_delete=models.CASCADE)
+    # Empty for guest checkouts
+    user = models.ForeignKey('auth.User', on_delete=models.CASCADE, null=True, blank=True)
     email = models.EmailField(blank=True, null=True)
 
     total_price = models.DecimalField(max_digits=10, decimal_places=2)
@@ -134,6 +311,15 @@ class Order(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # manage_orders pages newest first on (created_at, id), optionally
+        # narrowed to one status or one customer email
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='order_created_idx'),
+            models.Index(fields=['status', '-created_at', '-id'], name='order_status_created_idx'),
+            models.Index(Upper('email'), name='order_email_upper_idx'),
+        ]
+
     def __str__(self):
         return f"Order #{self.id}"
 
@@ -141,9 +327,117 @@ class Order(models.Model):
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE)
-    product = models.ForeignKey('shop.Product', on_delete=models.CASCADE)
+    # Kept for linking back to the shop; the line renders from the snapshot
+    # below, so it survives the product being edited or deleted
+    product = models.ForeignKey('shop.Product', on_delete=models.SET_NULL, null=True, blank=True)
+    variant = models.ForeignKey('shop.ProductVariant', on_delete=models.SET_NULL, null=True, blank=True)
     quantity = models.PositiveIntegerField()
-    
+
+    # Snapshot taken when the order is placed
+    title = models.CharField(max_length=255, default="")
+    variant_name = models.CharField(max_length=100, blank=True, default="")
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    line_total = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+
     def __str__(self):
-        return f"{self.quantity} x {self.product.title}"
+        return f"{self.quantity} x {self.title}"
 
+
+# ============================
+# STRIPE EVENTS
+# ============================
+class StripeEvent(models.Model):
+    """A verified webhook event, stored as received and handled later by
+    process_stripe_events. The unique event_id makes Stripe's retries no-ops."""
+
+    PENDING = "pending"
+    PROCESSED = "processed"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (PROCESSED, "Processed"),
+        (FAILED, "Failed"),
+    ]
+
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # A failed attempt pushes this back (see webhooks.backoff)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='stripe_event_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.type} {self.event_id}"
+
+
+# ============================
+# EMAIL OUTBOX
+# ============================
+class EmailOutbox(models.Model):
+    """An email waiting for send_outbox. Rows are written in the same
+    transaction as whatever caused them, so nothing waits on SMTP."""
+
+    PENDING = "pending"
+    # Claimed by a send_outbox run; next_attempt_at is then the lease expiry
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (SENDING, "Sending"),
+        (SENT, "Sent"),
+        (FAILED, "Failed"),
+    ]
+
+    # Enqueuing twice with the same key is a no-op, e.g. "order-confirmation:42"
+    key = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    to = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.subject} -> {self.to}"
+
+
+# ============================
+# STOCK HOLDS
+# ============================
+class StockHold(models.Model):
+    """Units set aside for one checkout until it is paid or expires.
+
+    reference ties the holds of one checkout together and travels to Stripe
+    in the session metadata. Each hold is matched by the same quantity in
+    the product's (or variant's) reserved column."""
+
+    reference = models.CharField(max_length=64, db_index=True)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='holds')
+    variant = models.ForeignKey(ProductVariant, on_delete=models.CASCADE, null=True, blank=True, related_name='holds')
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.quantity} x {self.variant or self.product} ({self.reference})"
@@ -0,0 +1,177 @@
+import logging
+import smtplib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .models import EmailOutbox
+
+logger = logging.getLogger(__name__)
+
+# ============================
+# EMAIL OUTBOX
+# ============================
+# Views and the Stripe worker only insert EmailOutbox rows; send_outbox
+# delivers them. Each batch goes over one SMTP connection (one TLS handshake
+# per batch, not per email). A failed message waits BACKOFF_BASE * 2^n
+# seconds before its next try and is parked as failed after MAX_ATTEMPTS.
+#
+# A batch is claimed in a short transaction (status "sending", leased for
+# LEASE), sent with no transaction open, and each result is saved as soon as
+# it's known. If the process dies mid-batch, what was sent stays sent; the
+# rest become due again when the lease runs out. Taking over an expired
+# lease charges an attempt, so an email that kills every run that sends it
+# ends up failed rather than retried forever.
+
+BATCH_SIZE = 50
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 60
+BACKOFF_MAX = 60 * 60 * 6
+LEASE = timedelta(minutes=10)
+LEASE_EXPIRED = "Lease expired: the run sending this email stopped"
+
+
+def connection_lost(exc):
+    """True when the connection itself is gone (not just this message refused).
+    The batch stops there; the rest wait for the next run without an attempt
+    charged. SMTPException subclasses OSError, hence the second check."""
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return True
+    return isinstance(exc, OSError) and not isinstance(exc, smtplib.SMTPException)
+
+
+def enqueue_email(to, subject, template, context, key=None):
+    """Queue a plain-text email rendered from template. Safe to call twice with the same key."""
+    if not to:
+        return
+    EmailOutbox.objects.bulk_create(
+        [EmailOutbox(key=key, to=to, subject=subject, body=render_to_string(template, context))],
+        ignore_conflicts=True,
+    )
+
+
+def backoff(attempts):
+    return timedelta(seconds=min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX))
+
+
+def claim(batch_size=BATCH_SIZE):
+    """Lease up to batch_size due emails to this run. Held locks last only this transaction."""
+    now = timezone.now()
+    with transaction.atomic():
+        due = list(
+            EmailOutbox.objects.select_for_update(skip_locked=True)
+            # A "sending" row past its lease belongs to a run that died
+            .filter(status__in=[EmailOutbox.PENDING, EmailOutbox.SENDING], next_attempt_at__lte=now)
+            .order_by("next_attempt_at", "id")[:batch_size]
+        )
+        expired = [item for item in due if item.status == EmailOutbox.SENDING]
+        for item in expired:
+            item.attempts += 1
+            item.last_error = LEASE_EXPIRED
+        dead = [item for item in expired if item.attempts >= MAX_ATTEMPTS]
+        if dead:
+            EmailOutbox.objects.filter(pk__in=[item.pk for item in dead]).update(
+                status=EmailOutbox.FAILED, attempts=F("attempts") + 1, last_error=LEASE_EXPIRED,
+            )
+            for item in dead:
+                logger.error("Giving up on email %s to %s: %s", item.pk, item.to, LEASE_EXPIRED)
+            due = [item for item in due if item not in dead]
+        EmailOutbox.objects.filter(pk__in=[item.pk for item in expired if item not in dead]).update(
+            attempts=F("attempts") + 1, last_error=LEASE_EXPIRED,
+        )
+        EmailOutbox.objects.filter(pk__in=[item.pk for item in due]).update(
+            status=EmailOutbox.SENDING, next_attempt_at=now + LEASE,
+        )
+    return due
+
+
+def unclaim(items):
+    """Hand claimed emails back, due now and with no attempt charged."""
+    EmailOutbox.objects.filter(pk__in=[item.pk for item in items], status=EmailOutbox.SENDING).update(
+        status=EmailOutbox.PENDING, next_attempt_at=timezone.now(),
+    )
+
+
+def send_batch(batch_size=BATCH_SIZE):
+    """Send up to batch_size due emails over one connection. Returns (sent, failed)."""
+    due = claim(batch_size)
+    if not due:
+        return 0, 0
+
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+    except OSError as exc:
+        logger.warning("Could not connect to SMTP; %s email(s) left queued: %s", len(due), exc)
+        unclaim(due)
+        return 0, 0
+
+    sent = failed = 0
+    try:
+        for n, item in enumerate(due):
+            message = EmailMessage(
+                item.subject, item.body, settings.DEFAULT_FROM_EMAIL, [item.to], connection=connection,
+            )
+            try:
+                connection.send_messages([message])
+            except Exception as exc:
+                if connection_lost(exc):
+                    logger.warning("SMTP connection lost after %s email(s): %s", sent, exc)
+                    unclaim(due[n:])
+                    break
+                record_failure(item, exc)
+                failed += 1
+            else:
+                item.status = EmailOutbox.SENT
+                item.attempts += 1
+                item.sent_at = timezone.now()
+                item.last_error = ""
+                item.save(update_fields=["status", "attempts", "sent_at", "last_error"])
+                sent += 1
+    finally:
+        try:
+            connection.close()
+        except OSError:
+            pass
+    return sent, failed
+
+
+def record_failure(item, exc):
+    item.attempts += 1
+    item.last_error = f"{type(exc).__name__}: {exc}"
+    if item.attempts >= MAX_ATTEMPTS:
+        item.status = EmailOutbox.FAILED
+        logger.error("Giving up on email %s to %s: %s", item.pk, item.to, item.last_error)
+    else:
+        item.status = EmailOutbox.PENDING
+        item.next_attempt_at = timezone.now() + backoff(item.attempts)
+    item.save(update_fields=["status", "attempts", "last_error", "next_attempt_at"])
+
+
+# ============================
+# ORDER EMAILS
+# ============================
+
+def enqueue_order_confirmation(order):
+    enqueue_email(
+        order.email,
+        "Your Piffy Studio Order Confirmation",
+        "emails/order_confirmation.txt",
+        {"order": order, "items": order.items.all()},
+        key=f"order-confirmation:{order.pk}",
+    )
+
+
+def enqueue_order_shipped(order):
+    enqueue_email(
+        order.email,
+        "Your Piffy Studio Order Has Shipped",
+        "emails/order_shipped.txt",
+        {"order": order, "items": order.items.all()},
+        key=f"order-shipped:{order.pk}",
+    )
@@ -0,0 +1,91 @@
+import base64
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from django.db.models import Q
+
+
+# ============================
+# KEYSET (CURSOR) PAGINATION
+# ============================
+# Pages are anchored on the last row seen instead of an OFFSET, so page N
+# is one indexed range scan just like page 1. Rows are ordered newest first
+# on (created_at, id); id breaks ties between rows saved in the same instant.
+
+PAGE_SIZE = 24
+
+
+def encode_cursor(created_at, pk):
+    raw = f"{created_at.isoformat()}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return (created_at, pk) or None for a missing or tampered cursor."""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        stamp, pk = base64.urlsafe_b64decode(padded).decode().split("|")
+        return datetime.fromisoformat(stamp), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+@dataclass
+class KeysetPage:
+    object_list: list
+    next_cursor: str = None
+    querydict: dict = field(default=None, repr=False)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def next_query(self):
+        """Current query string with the cursor swapped for the next page."""
+        params = self.querydict.copy()
+        params["cursor"] = self.next_cursor
+        return params.urlencode()
+
+    @property
+    def first_query(self):
+        """Current query string (filters kept) back at the first page."""
+        params = self.querydict.copy()
+        params.pop("cursor", None)
+        return params.urlencode()
+
+
+def keyset_slice(queryset, cursor, per_page=PAGE_SIZE, field_name="created_at"):
+    """Return (rows, next_cursor) newest-first, starting after cursor. One query."""
+    queryset = queryset.order_by(f"-{field_name}", "-id")
+
+    after = decode_cursor(cursor)
+    if after:
+        stamp, pk = after
+        queryset = queryset.filter(
+            Q(**{f"{field_name}__lt": stamp}) | Q(**{field_name: stamp, "id__lt": pk})
+        )
+
+    # One extra row tells us whether there is a next page without a COUNT(*)
+    rows = list(queryset[:per_page + 1])
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, field_name), last.pk)
+
+    return rows, next_cursor
+
+
+def keyset_paginate(request, queryset, per_page=PAGE_SIZE, field_name="created_at"):
+    """Paginate a queryset from ?cursor= on the request."""
+    rows, next_cursor = keyset_slice(queryset, request.GET.get("cursor"), per_page, field_name)
+    return KeysetPage(rows, next_cursor, request.GET)
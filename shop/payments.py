@@ -0,0 +1,55 @@
+import threading
+import uuid
+
+import stripe
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+# ============================
+# STRIPE CLIENT
+# ============================
+# One StripeClient per process instead of setting stripe.api_key in every
+# view. Its RequestsClient keeps a requests.Session per thread, so the TLS
+# connection to Stripe is reused across requests. Connect and read timeouts
+# cap how long a gunicorn worker can wait on Stripe. Failed calls are retried
+# with the same Idempotency-Key, so Stripe applies a POST at most once.
+
+_client = None
+_lock = threading.Lock()
+
+
+def build_client():
+    base = getattr(settings, "STRIPE_API_BASE", "")
+    timeout = (
+        getattr(settings, "STRIPE_CONNECT_TIMEOUT", 3),
+        getattr(settings, "STRIPE_READ_TIMEOUT", 10),
+    )
+    return stripe.StripeClient(
+        settings.STRIPE_SECRET_KEY or "",
+        http_client=stripe.RequestsClient(timeout=timeout),
+        max_network_retries=getattr(settings, "STRIPE_MAX_RETRIES", 2),
+        base_addresses={"api": base} if base else None,
+    )
+
+
+def stripe_client():
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = build_client()
+    return _client
+
+
+def idempotency_key(prefix):
+    """A fresh key for one logical call; the SDK resends it on every retry."""
+    return f"{prefix}-{uuid.uuid4().hex}"
+
+
+@receiver(setting_changed)
+def reset_client(setting, **kwargs):
+    global _client
+    if setting.startswith("STRIPE_"):
+        with _lock:
+            _client = None
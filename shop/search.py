@@ -0,0 +1,128 @@
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import F, Q
+
+from .models import Product
+
+# ============================
+# PRODUCT SEARCH
+# ============================
+# Postgres: Product.search_vector is kept up to date by a trigger (migration
+# 0007) and served by a GIN index. SQLite (local runs, tests): an FTS5
+# external-content table mirrors title/description through triggers that
+# are (re)installed after every migrate. Anything else falls back to
+# icontains.
+
+MAX_RESULTS = 48
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def search_terms(query):
+    """Split user input into plain words; drops all query-syntax characters."""
+    return WORD_RE.findall(query.lower())[:8]
+
+
+def search_products(query, limit=MAX_RESULTS):
+    """Return matching products, best match first, ready for product cards."""
+    terms = search_terms(query)
+    if not terms:
+        return []
+
+    if connection.vendor == "postgresql":
+        return _search_postgres(terms, limit)
+    if connection.vendor == "sqlite":
+        return _search_sqlite(terms, limit)
+    return _search_fallback(terms, limit)
+
+
+def _search_postgres(terms, limit):
+    # Every word must match; the last one as a prefix so results follow typing
+    raw = " & ".join(terms[:-1] + [f"{terms[-1]}:*"])
+    query = SearchQuery(raw, search_type="raw", config="english")
+    return list(
+        Product.objects.for_cards()
+        .filter(search_vector=query)
+        .annotate(rank=SearchRank(F("search_vector"), query))
+        .order_by("-rank", "-created_at")[:limit]
+    )
+
+
+def _search_sqlite(terms, limit):
+    match = " ".join(f'"{t}"' for t in terms[:-1]) + f' "{terms[-1]}"*'
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT rowid FROM shop_product_fts WHERE shop_product_fts MATCH %s "
+            "ORDER BY bm25(shop_product_fts, 10.0, 1.0) LIMIT %s",
+            [match.strip(), limit],
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+
+    products = Product.objects.for_cards().in_bulk(ids)
+    return [products[pk] for pk in ids if pk in products]
+
+
+def _search_fallback(terms, limit):
+    condition = Q()
+    for term in terms:
+        condition &= Q(title__icontains=term) | Q(description__icontains=term)
+    return list(Product.objects.for_cards().filter(condition).order_by("-created_at")[:limit])
+
+
+# ============================
+# SQLITE FTS5 INSTALL
+# ============================
+# Django rebuilds SQLite tables for many schema changes, which silently drops
+# their triggers, so this runs on post_migrate rather than once in a migration.
+
+SQLITE_TRIGGERS = {
+    "shop_product_fts_ai": """
+        CREATE TRIGGER IF NOT EXISTS shop_product_fts_ai AFTER INSERT ON shop_product BEGIN
+            INSERT INTO shop_product_fts(rowid, title, description)
+            VALUES (new.id, new.title, new.description);
+        END
+    """,
+    "shop_product_fts_ad": """
+        CREATE TRIGGER IF NOT EXISTS shop_product_fts_ad AFTER DELETE ON shop_product BEGIN
+            INSERT INTO shop_product_fts(shop_product_fts, rowid, title, description)
+            VALUES ('delete', old.id, old.title, old.description);
+        END
+    """,
+    "shop_product_fts_au": """
+        CREATE TRIGGER IF NOT EXISTS shop_product_fts_au AFTER UPDATE OF title, description ON shop_product BEGIN
+            INSERT INTO shop_product_fts(shop_product_fts, rowid, title, description)
+            VALUES ('delete', old.id, old.title, old.description);
+            INSERT INTO shop_product_fts(rowid, title, description)
+            VALUES (new.id, new.title, new.description);
+        END
+    """,
+}
+
+
+def install_sqlite_fts(using="default", **kwargs):
+    from django.db import connections
+
+    conn = connections[using]
+    if conn.vendor != "sqlite":
+        return
+
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE name = 'shop_product_fts' OR name IN (%s, %s, %s)",
+            list(SQLITE_TRIGGERS),
+        )
+        present = {row[0] for row in cursor.fetchall()}
+        if len(present) == len(SQLITE_TRIGGERS) + 1:
+            return
+
+        cursor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS shop_product_fts USING fts5("
+            "title, description, content='shop_product', content_rowid='id', "
+            "tokenize='porter unicode61')"
+        )
+        for sql in SQLITE_TRIGGERS.values():
+            cursor.execute(sql)
+        # Rows changed while a trigger was missing are only picked up by a rebuild
+        cursor.execute("INSERT INTO shop_product_fts(shop_product_fts) VALUES ('rebuild')")
@@ -0,0 +1,58 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .cache import catalog_cache
+from .cart import merge_session_cart
+from .models import Category, Product, ProductImage, ProductVariant
+from .storage import release_product_image
+
+CATALOG_MODELS = (Product, ProductImage, ProductVariant, Category)
+
+
+# ============================
+# CATALOG CACHE INVALIDATION
+# ============================
+
+def bump_catalog_version(sender, **kwargs):
+    # Bump after commit so no worker can refill the cache from pre-commit rows
+    transaction.on_commit(catalog_cache.bump)
+
+
+# Connected per model: a catch-all receiver would stop Django fast-deleting
+# every other model (carts, sessions) without loading the rows first
+for model in CATALOG_MODELS:
+    post_save.connect(bump_catalog_version, sender=model)
+    post_delete.connect(bump_catalog_version, sender=model)
+
+
+# ============================
+# PRODUCT PAGE VALIDATORS
+# ============================
+
+@receiver(post_delete, sender=ProductImage)
+@receiver(post_delete, sender=ProductVariant)
+def touch_product(sender, instance, **kwargs):
+    # A deleted child leaves no newer timestamp, so move Last-Modified forward here
+    Product.objects.filter(pk=instance.product_id).update(updated_at=timezone.now())
+
+
+# ============================
+# IMAGE FILES
+# ============================
+
+@receiver(post_delete, sender=ProductImage)
+def release_image_files(sender, instance, **kwargs):
+    release_product_image(instance.image.name, instance.derivatives)
+
+
+# ============================
+# CART MERGE ON LOGIN
+# ============================
+
+@receiver(user_logged_in)
+def merge_guest_cart(sender, request, user, **kwargs):
+    if request is not None and hasattr(request, "session"):
+        merge_session_cart(request, user)
@@ -0,0 +1,117 @@
+import socketserver
+import threading
+from email import message_from_bytes
+
+# ============================
+# SMTP STUB SERVER
+# ============================
+# A minimal in-process SMTP server for tests and local runs of send_outbox:
+# plain text, no TLS or AUTH. It records every message and how many
+# connections were opened, and refuses recipients listed in reject.
+
+
+class SMTPStub:
+    def __init__(self, host="127.0.0.1", port=0, reject=()):
+        self.reject = set(reject)
+        self.messages = []
+        self.connections = 0
+        self._lock = threading.Lock()
+
+        handler = type("Handler", (SMTPHandler,), {"stub": self})
+        self.server = socketserver.ThreadingTCPServer((host, port), handler)
+        self.server.daemon_threads = True
+
+    @property
+    def host(self):
+        return self.server.server_address[0]
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def settings(self):
+        """Django settings that point the SMTP backend here."""
+        return {
+            "EMAIL_BACKEND": "django.core.mail.backends.smtp.EmailBackend",
+            "EMAIL_HOST": self.host,
+            "EMAIL_PORT": self.port,
+            "EMAIL_USE_TLS": False,
+            "EMAIL_USE_SSL": False,
+            "EMAIL_HOST_USER": "",
+            "EMAIL_HOST_PASSWORD": "",
+        }
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.messages.clear()
+            self.connections = 0
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    stub = None
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        with self.stub._lock:
+            self.stub.connections += 1
+        self.reply("220 smtp-stub ready")
+        sender, recipients = None, []
+
+        for raw in self.rfile:
+            command = raw.decode(errors="replace").rstrip("\r\n")
+            verb = command.split(" ", 1)[0].upper()
+
+            if verb == "EHLO":
+                self.reply("250-smtp-stub")
+                self.reply("250 8BITMIME")
+            elif verb == "HELO":
+                self.reply("250 smtp-stub")
+            elif verb == "MAIL":
+                sender, recipients = command.split(":", 1)[1].strip(" <>"), []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                address = command.split(":", 1)[1].strip(" <>")
+                if address in self.stub.reject:
+                    self.reply("550 No such user")
+                else:
+                    recipients.append(address)
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                self.store(sender, recipients, self.read_data())
+                self.reply("250 OK queued")
+            elif verb in ("RSET", "NOOP"):
+                sender, recipients = (None, []) if verb == "RSET" else (sender, recipients)
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+    def read_data(self):
+        lines = []
+        for raw in self.rfile:
+            if raw in (b".\r\n", b".\n"):
+                break
+            # Undo dot-stuffing
+            lines.append(raw[1:] if raw.startswith(b"..") else raw)
+        return b"".join(lines)
+
+    def store(self, sender, recipients, data):
+        with self.stub._lock:
+            self.stub.messages.append({
+                "from": sender,
+                "to": list(recipients),
+                "message": message_from_bytes(data),
+            })
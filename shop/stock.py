@@ -0,0 +1,153 @@
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, PositiveIntegerField, Value, When
+from django.utils import timezone
+
+from .models import Product, ProductVariant, StockHold
+
+# ============================
+# STOCK RESERVATIONS
+# ============================
+# Starting a checkout takes a hold: reserved += n WHERE stock - reserved >= n,
+# one conditional UPDATE per line. Concurrent checkouts for the same print
+# queue on that row's lock and the database re-checks the condition for
+# each, so the last unit goes to exactly one of them, with no read-then-write
+# gap to oversell through. Paying converts the hold into a sale
+# (stock -= n WHERE stock >= n, reserved -= held). Holds nobody paid for are
+# released in bulk by release_stock_holds, or at once when Stripe reports the
+# session expired.
+#
+# Lines are (product_id, variant_id) keys; a variant's own stock is used
+# when variant_id is set.
+
+# Stripe only accepts a Checkout expiry 30 minutes to 24 hours ahead
+HOLD_MINUTES = getattr(settings, "SHOP_STOCK_HOLD_MINUTES", 35)
+
+
+class OutOfStock(Exception):
+    def __init__(self, keys):
+        self.keys = keys
+        super().__init__(f"Not enough stock for {keys}")
+
+
+def stock_target(key):
+    """(model, pk) whose stock covers a (product_id, variant_id) line."""
+    product_id, variant_id = key
+    return (ProductVariant, variant_id) if variant_id else (Product, product_id)
+
+
+def totals(lines):
+    wanted = defaultdict(int)
+    for product_id, variant_id, quantity in lines:
+        wanted[(product_id, variant_id)] += quantity
+    # Fixed order, so two multi-line checkouts always lock rows in the same sequence
+    return dict(sorted(wanted.items(), key=lambda item: (item[0][0], item[0][1] or 0)))
+
+
+def reserve(lines, minutes=HOLD_MINUTES):
+    """Hold stock for [(product_id, variant_id, quantity)], all or nothing.
+
+    Returns (reference, expires_at); raises OutOfStock, holding nothing, if
+    any line can't be covered."""
+    reference = uuid.uuid4().hex
+    expires_at = timezone.now() + timedelta(minutes=minutes)
+    wanted = totals(lines)
+
+    with transaction.atomic():
+        short = []
+        for key, quantity in wanted.items():
+            model, pk = stock_target(key)
+            updated = model.objects.filter(pk=pk, stock__gte=F("reserved") + quantity).update(
+                reserved=F("reserved") + quantity,
+            )
+            if not updated:
+                short.append(key)
+        if short:
+            # Raising rolls back the lines that did fit
+            raise OutOfStock(short)
+
+        StockHold.objects.bulk_create([
+            StockHold(reference=reference, product_id=pid, variant_id=vid, quantity=quantity, expires_at=expires_at)
+            for (pid, vid), quantity in wanted.items()
+        ])
+    return reference, expires_at
+
+
+def convert(reference, sold):
+    """Turn a checkout's holds into sales. sold is [(product_id, variant_id, quantity)].
+
+    Must run inside the caller's transaction. Returns the keys that could not
+    be covered from stock (their hold had lapsed and the units were sold)."""
+    holds = list(StockHold.objects.select_for_update().filter(reference=reference)) if reference else []
+    held = defaultdict(int)
+    for hold in holds:
+        held[(hold.product_id, hold.variant_id)] += hold.quantity
+    if holds:
+        StockHold.objects.filter(pk__in=[h.pk for h in holds]).delete()
+
+    short = []
+    for key, quantity in totals(sold).items():
+        model, pk = stock_target(key)
+        own = held.pop(key, 0)
+        updated = model.objects.filter(pk=pk, stock__gte=quantity).update(
+            stock=F("stock") - quantity,
+            reserved=F("reserved") - own,
+        )
+        if not updated:
+            short.append(key)
+            held[key] = own
+
+    # Anything held but not bought (or not coverable) goes back
+    release_quantities(held)
+    return short
+
+
+def release_quantities(held):
+    """reserved -= quantity for {(product_id, variant_id): quantity}: one UPDATE per model."""
+    amounts = {Product: defaultdict(int), ProductVariant: defaultdict(int)}
+    for key, quantity in held.items():
+        if quantity:
+            model, pk = stock_target(key)
+            amounts[model][pk] += quantity
+
+    for model, by_pk in amounts.items():
+        if by_pk:
+            model.objects.filter(pk__in=by_pk).update(reserved=F("reserved") - Case(
+                *[When(pk=pk, then=Value(quantity)) for pk, quantity in by_pk.items()],
+                output_field=PositiveIntegerField(),
+            ))
+
+
+def release_holds(holds):
+    held = defaultdict(int)
+    for hold in holds:
+        held[(hold.product_id, hold.variant_id)] += hold.quantity
+    StockHold.objects.filter(pk__in=[h.pk for h in holds]).delete()
+    release_quantities(held)
+
+
+def release(reference):
+    """Give back every unit a checkout still holds (abandoned or failed)."""
+    with transaction.atomic():
+        release_holds(list(StockHold.objects.select_for_update().filter(reference=reference)))
+
+
+def release_expired(grace_minutes=5, batch_size=1000):
+    """Release holds that expired more than grace_minutes ago, batch by batch. Returns holds released."""
+    cutoff = timezone.now() - timedelta(minutes=grace_minutes)
+    released = 0
+    while True:
+        with transaction.atomic():
+            holds = list(
+                StockHold.objects.select_for_update(skip_locked=True)
+                .filter(expires_at__lt=cutoff)
+                .order_by("pk")[:batch_size]
+            )
+            if not holds:
+                return released
+            release_holds(holds)
+        released += len(holds)
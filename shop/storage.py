@@ -0,0 +1,58 @@
+import hashlib
+import posixpath
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import transaction
+
+# ============================
+# CONTENT-ADDRESSED STORAGE
+# ============================
+# Product uploads are named by the SHA-256 of their bytes, e.g.
+# products/3f/3fa4...c2.jpg, so the same artwork uploaded to several
+# products is written once. The ProductImage rows pointing at a name are
+# its reference count: files are only deleted when the last row goes.
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    def digest(self, content):
+        sha = hashlib.sha256()
+        for chunk in content.chunks():
+            sha.update(chunk)
+        content.seek(0)
+        return sha.hexdigest()
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+
+        digest = self.digest(content)
+        directory, filename = posixpath.split(name)
+        ext = posixpath.splitext(filename)[1].lower()
+        name = posixpath.join(directory, digest[:2], digest + ext)
+
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length)
+
+
+def product_image_storage():
+    return ContentAddressedStorage()
+
+
+def release_product_image(name, derivatives):
+    """Delete a file and its derivatives once no ProductImage references it."""
+    from .models import ProductImage
+
+    def release():
+        if not name or ProductImage.objects.filter(image=name).exists():
+            return
+        ProductImage._meta.get_field("image").storage.delete(name)
+        for names in (derivatives or {}).values():
+            for derived in names.values():
+                default_storage.delete(derived)
+
+    # After commit, so a rolled-back delete never loses the file
+    transaction.on_commit(release)
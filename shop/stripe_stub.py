@@ -0,0 +1,293 @@
+import hashlib
+import hmac
+import json
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# ============================
+# STRIPE STUB SERVER
+# ============================
+# Just enough of the Stripe API for this shop, over plain HTTP: create and
+# retrieve Checkout Sessions, list their line items (paged, with
+# data.price.product expansion) and replay responses for a repeated
+# Idempotency-Key. It can also sign a checkout.session.completed event and
+# POST it to the webhook. Point the app at it with STRIPE_API_BASE to
+# load-test checkout and the webhook offline (manage.py stripe_stub).
+
+SESSION_PATH = re.compile(r"^/v1/checkout/sessions/(?P<id>[\w-]+)(?P<line_items>/line_items)?$")
+COMPLETE_PATH = re.compile(r"^/stub/sessions/(?P<id>[\w-]+)/complete$")
+KEY_PART = re.compile(r"[^\[\]]+")
+
+
+def parse_form(pairs):
+    """Stripe's bracketed form encoding (a[b][0][c]=v) back into dicts and lists."""
+    root = {}
+    for key, value in pairs:
+        parts = KEY_PART.findall(key)
+        node = root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return listify(root)
+
+
+def listify(node):
+    if not isinstance(node, dict):
+        return node
+    if node and all(k.isdigit() for k in node):
+        return [listify(node[k]) for k in sorted(node, key=int)]
+    return {k: listify(v) for k, v in node.items()}
+
+
+def sign(payload, secret, timestamp=None):
+    """A Stripe-Signature header for payload (bytes)."""
+    timestamp = int(timestamp or time.time())
+    signed = f"{timestamp}.".encode() + payload
+    digest = hmac.new(secret.encode(), signed, hashlib.sha256).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def new_id(prefix):
+    return f"{prefix}_test_{uuid.uuid4().hex[:24]}"
+
+
+class StripeStub:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, page_size=100,
+                 webhook_url="", webhook_secret="", auto_complete=False, quiet=True):
+        self.latency = latency
+        self.page_size = page_size
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.auto_complete = auto_complete
+        self.quiet = quiet
+
+        # Failure injection: answer the next N API calls with a 503
+        self.fail_next = 0
+        self.sessions = {}
+        self.requests = []
+        self._replays = {}
+        self._lock = threading.Lock()
+
+        handler = type("Handler", (StubHandler,), {"stub": self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Serve from a background thread (tests, benchmarks)."""
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # ---------- API ----------
+
+    def create_session(self, params):
+        session_id = new_id("cs")
+        lines = []
+        for n, line in enumerate(params.get("line_items", [])):
+            price_data = line.get("price_data", {})
+            product_data = price_data.get("product_data", {})
+            quantity = int(line.get("quantity", 1))
+            unit_amount = int(price_data.get("unit_amount", 0))
+            lines.append({
+                "id": f"li_{session_id[8:]}_{n}",
+                "object": "item",
+                "description": product_data.get("name", ""),
+                "quantity": quantity,
+                "amount_total": unit_amount * quantity,
+                "currency": price_data.get("currency", "gbp"),
+                "price": {
+                    "id": f"price_{session_id[8:]}_{n}",
+                    "object": "price",
+                    "currency": price_data.get("currency", "gbp"),
+                    "unit_amount": unit_amount,
+                    "product": {
+                        "id": f"prod_{session_id[8:]}_{n}",
+                        "object": "product",
+                        "name": product_data.get("name", ""),
+                        "metadata": product_data.get("metadata", {}),
+                    },
+                },
+            })
+
+        session = {
+            "id": session_id,
+            "object": "checkout.session",
+            "mode": params.get("mode", "payment"),
+            "status": "open",
+            "payment_status": "unpaid",
+            "amount_total": sum(li["amount_total"] for li in lines),
+            "currency": "gbp",
+            "customer_email": params.get("customer_email"),
+            "metadata": params.get("metadata", {}),
+            "success_url": params.get("success_url", ""),
+            "cancel_url": params.get("cancel_url", ""),
+            "url": f"{self.url}/pay/{session_id}",
+        }
+        with self._lock:
+            self.sessions[session_id] = {"session": session, "line_items": lines}
+
+        if self.auto_complete and self.webhook_url:
+            threading.Thread(target=self.complete, args=(session_id,), daemon=True).start()
+        return session
+
+    def list_line_items(self, session_id, query):
+        lines = self.sessions[session_id]["line_items"]
+        limit = min(int(query.get("limit", 10)), self.page_size)
+        start = 0
+        if query.get("starting_after"):
+            ids = [li["id"] for li in lines]
+            start = ids.index(query["starting_after"]) + 1
+
+        expand = query.get("expand", [])
+        page = []
+        for li in lines[start:start + limit]:
+            if "data.price.product" not in expand:
+                li = {**li, "price": {**li["price"], "product": li["price"]["product"]["id"]}}
+            page.append(li)
+
+        return {
+            "object": "list",
+            "url": f"/v1/checkout/sessions/{session_id}/line_items",
+            "has_more": start + limit < len(lines),
+            "data": page,
+        }
+
+    # ---------- webhook ----------
+
+    def completed_event(self, session_id):
+        session = dict(self.sessions[session_id]["session"])
+        session.update({
+            "status": "complete",
+            "payment_status": "paid",
+            "payment_intent": new_id("pi"),
+            "customer_details": {"email": session["customer_email"] or "buyer@example.com", "name": "Stub Buyer"},
+            "collected_information": {"shipping_details": {
+                "name": "Stub Buyer",
+                "address": {"line1": "1 Test Street", "line2": None, "city": "London",
+                            "postal_code": "E1 6AN", "country": "GB"},
+            }},
+        })
+        return {
+            "id": new_id("evt"),
+            "object": "event",
+            "type": "checkout.session.completed",
+            "created": int(time.time()),
+            "data": {"object": session},
+        }
+
+    def complete(self, session_id):
+        """Sign and POST checkout.session.completed to the webhook. Returns (status, seconds)."""
+        payload = json.dumps(self.completed_event(session_id)).encode()
+        request = urllib.request.Request(self.webhook_url, data=payload, method="POST", headers={
+            "Content-Type": "application/json",
+            "Stripe-Signature": sign(payload, self.webhook_secret),
+        })
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                status = response.status
+        except urllib.error.HTTPError as exc:
+            status = exc.code
+        except OSError:
+            status = 0
+        return status, time.perf_counter() - started
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    stub = None
+    # Keep-alive, so clients can reuse connections; headers and body go out in
+    # separate writes, and Nagle would hold the second for a delayed ACK
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if not self.stub.quiet:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def dispatch(self, method):
+        parts = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        query = parse_form(parse_qsl(parts.query))
+        key = self.headers.get("Idempotency-Key")
+
+        stub = self.stub
+        with stub._lock:
+            stub.requests.append({
+                "method": method,
+                "path": parts.path,
+                "idempotency_key": key,
+                "client_port": self.client_address[1],
+            })
+            failing = stub.fail_next > 0
+            if failing:
+                stub.fail_next -= 1
+            replay = stub._replays.get(key) if key else None
+
+        if stub.latency:
+            time.sleep(stub.latency)
+        if failing:
+            return self.reply(503, {"error": {"type": "api_error", "message": "Stub outage"}})
+        if replay:
+            return self.reply(*replay, replayed=True)
+
+        status, payload = self.route(method, parts.path, query, parse_form(parse_qsl(body.decode())))
+        if key and method == "POST":
+            with stub._lock:
+                stub._replays[key] = (status, payload)
+        self.reply(status, payload)
+
+    def route(self, method, path, query, form):
+        stub = self.stub
+        if method == "POST" and path == "/v1/checkout/sessions":
+            return 200, stub.create_session(form)
+
+        match = SESSION_PATH.match(path)
+        if method == "GET" and match and match["id"] in stub.sessions:
+            if match["line_items"]:
+                return 200, stub.list_line_items(match["id"], query)
+            return 200, stub.sessions[match["id"]]["session"]
+
+        match = COMPLETE_PATH.match(path)
+        if method == "POST" and match and match["id"] in stub.sessions:
+            status, elapsed = stub.complete(match["id"])
+            return 200, {"webhook_status": status, "elapsed_ms": round(elapsed * 1000, 1)}
+
+        return 404, {"error": {"type": "invalid_request_error", "message": f"No such route: {method} {path}"}}
+
+    def reply(self, status, payload, replayed=False):
+        body = json.dumps(payload).encode()
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Request-Id", new_id("req"))
+            if replayed:
+                self.send_header("Idempotent-Replayed", "true")
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up (e.g. its read timeout fired during --latency-ms)
+            self.close_connection = True
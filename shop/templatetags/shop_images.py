@@ -0,0 +1,33 @@
+from django import template
+from django.core.files.storage import default_storage
+
+register = template.Library()
+
+
+# ============================
+# RESPONSIVE IMAGES
+# ============================
+
+@register.simple_tag
+def srcset(image, fmt="jpeg"):
+    """srcset value ("url 320w, url 640w") for one derivative format of a ProductImage."""
+    names = (image.derivatives or {}).get(fmt) or {}
+    return ", ".join(
+        f"{default_storage.url(name)} {width}w"
+        for width, name in sorted(names.items(), key=lambda kv: int(kv[0]))
+    )
+
+
+@register.inclusion_tag("shop/includes/picture.html")
+def product_picture(image, alt="", css_class="", sizes="100vw", img_id="", loading="lazy"):
+    """<picture> with WebP and JPEG srcsets, intrinsic size and a loading placeholder."""
+    return {
+        "image": image,
+        "webp": srcset(image, "webp"),
+        "jpeg": srcset(image, "jpeg"),
+        "alt": alt,
+        "css_class": css_class,
+        "sizes": sizes,
+        "img_id": img_id,
+        "loading": loading,
+    }
@@ -1,3 +1,1851 @@
-from django.test import TestCase
+import csv
+import json
+import os
+import re
+from datetime import timedelta
+from decimal import Decimal
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends.smtp import EmailBackend
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, connections, transaction
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from .cache import catalog_cache
+from .cart import cart_count_key, get_session_cart, save_session_cart
+from .exports import export_lines
+from .models import (
+    Cart, CartItem, Category, EmailOutbox, Order, OrderItem, Product, ProductImage, ProductVariant,
+    StockHold, StripeEvent,
+)
+from .pagination import PAGE_SIZE, decode_cursor, encode_cursor
+from .outbox import MAX_ATTEMPTS as OUTBOX_MAX_ATTEMPTS, enqueue_email, send_batch
+from .search import search_products
+from .stock import OutOfStock, convert, release_expired, reserve
+from .smtp_stub import SMTPStub
+from .stripe_stub import StripeStub, sign
+from .views import ORDERS_PER_PAGE
+from .webhooks import MAX_ATTEMPTS, process_pending
+
+
+# Templates use {% static %}; the manifest storage needs collectstatic first.
+# Caches are per-process memory so runs never see each other's entries.
+shop_settings = override_settings(
+    STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage",
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+)
+
+
+class FreshCachesMixin:
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        catalog_cache.clear_local()
+        catalog_cache.reset_stats()
+
+
+@shop_settings
+class ShopTestCase(FreshCachesMixin, TestCase):
+    pass
+
+
+@shop_settings
+class ShopTransactionTestCase(FreshCachesMixin, TransactionTestCase):
+    """For tests that need real commits, e.g. threads racing on separate connections."""
+
+
+def make_upload(name="art.jpg", size=(1200, 800), mode="RGB", fmt="JPEG"):
+    buffer = BytesIO()
+    Image.new(mode, size, (200, 40, 40) if mode == "RGB" else (200, 40, 40, 128)).save(buffer, fmt)
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type=f"image/{fmt.lower()}")
+
+
+class MediaTestCase(ShopTestCase):
+    """Writes uploads to a throwaway MEDIA_ROOT."""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.media_root = media_root
+
+
+def make_product(category, n, images=2):
+    product = Product.objects.create(
+        title=f"Print {n}", category=category, price="25.00",
+    )
+    # Rows only: the files don't exist, so skip save()'s metadata read
+    ProductImage.objects.bulk_create(
+        ProductImage(product=product, image=f"products/{n}-{pos}.jpg", position=images - pos)
+        for pos in range(images)
+    )
+    return product
+
+
+# ============================
+# PRODUCT LIST
+# ============================
+class ProductListQueryTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = Category.objects.create(name="Prints")
+
+    def count_queries(self):
+        cache.clear()
+        catalog_cache.clear_local()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse("shop:shop_index"))
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_query_count_does_not_grow_with_catalog(self):
+        for n in range(3):
+            make_product(self.category, n)
+        small = self.count_queries()
+
+        for n in range(3, 30):
+            make_product(self.category, n)
+        self.assertEqual(self.count_queries(), small)
+        self.assertLessEqual(small, 3)
+
+    def test_card_shows_lowest_position_image(self):
+        make_product(self.category, 1, images=3)
+        response = self.client.get(reverse("shop:shop_index"))
+        # positions run 3, 2, 1 — the last upload is the primary image
+        self.assertContains(response, "/media/products/1-2.jpg")
+        self.assertNotContains(response, "/media/products/1-0.jpg")
+
+    def test_pages_do_not_load_the_search_vector(self):
+        make_product(self.category, 1)
+        for url in (reverse("shop:shop_index"), reverse("shop:product_detail", args=["print-1"])):
+            cache.clear()
+            catalog_cache.clear_local()
+            with CaptureQueriesContext(connection) as ctx:
+                self.client.get(url)
+            product_queries = [q["sql"] for q in ctx.captured_queries if 'FROM "shop_product"' in q["sql"]]
+            self.assertTrue(product_queries)
+            self.assertFalse([sql for sql in product_queries if "search_vector" in sql])
+
+    def test_saving_a_deferred_product_leaves_the_vector_alone(self):
+        product = Product.objects.for_cards().get(pk=make_product(self.category, 1).pk)
+        product.stock = 4
+
+        with CaptureQueriesContext(connection) as ctx:
+            product.save()
+
+        self.assertEqual(len(ctx.captured_queries), 1)
+        self.assertNotIn("search_vector", ctx.captured_queries[0]["sql"])
+
+
+# ============================
+# KEYSET PAGINATION
+# ============================
+class KeysetPaginationTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.prints = Category.objects.create(name="Prints")
+        self.zines = Category.objects.create(name="Zines")
+        for n in range(PAGE_SIZE + 6):
+            make_product(self.prints if n % 2 else self.zines, n, images=0)
+
+    def walk(self, url, params=None):
+        seen = []
+        params = dict(params or {})
+        while True:
+            response = self.client.get(url, params)
+            page = response.context["page"]
+            seen.extend(p.pk for p in page)
+            if not page.has_next:
+                return seen
+            params["cursor"] = page.next_cursor
+
+    def test_walks_every_product_once_newest_first(self):
+        seen = self.walk(reverse("shop:shop_index"))
+        expected = list(
+            Product.objects.order_by("-created_at", "-id").values_list("pk", flat=True)
+        )
+        self.assertEqual(seen, expected)
+
+    def test_category_filter(self):
+        seen = self.walk(reverse("shop:shop_index"), {"category": "prints"})
+        self.assertEqual(set(seen), set(self.prints.products.values_list("pk", flat=True)))
+
+    def test_manage_products_filters_by_category_id(self):
+        staff = User.objects.create_user("staff", password="pw")
+        self.client.force_login(staff)
+        seen = self.walk(reverse("shop:manage_products"), {"category": self.zines.pk})
+        self.assertEqual(set(seen), set(self.zines.products.values_list("pk", flat=True)))
+
+    def test_manage_first_page_link_keeps_every_filter(self):
+        self.client.force_login(User.objects.create_user("staff", password="pw"))
+        url = reverse("shop:manage_products")
+        first = self.client.get(url, {"category": self.zines.pk, "sort": "title"})
+
+        later = self.client.get(f"{url}?{first.context['page'].next_query}")
+
+        self.assertContains(later, f'href="?category={self.zines.pk}&amp;sort=title"')
+
+    def test_bad_cursor_falls_back_to_first_page(self):
+        self.assertIsNone(decode_cursor("not-a-cursor"))
+        product = Product.objects.first()
+        self.assertEqual(
+            decode_cursor(encode_cursor(product.created_at, product.pk)),
+            (product.created_at, product.pk),
+        )
+
+
+# ============================
+# SEARCH
+# ============================
+class ProductSearchTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Prints")
+        self.moth = Product.objects.create(
+            title="Moth Risograph", category=category, price="20.00",
+            description="Two-colour print on cream stock.",
+        )
+        self.eel = Product.objects.create(
+            title="Eel Zine", category=category, price="8.00",
+            description="A risograph zine about moths and eels.",
+        )
+
+    def test_title_match_ranks_above_description_match(self):
+        self.assertEqual(search_products("moth"), [self.moth, self.eel])
+
+    def test_prefix_matches_last_word_while_typing(self):
+        self.assertEqual(search_products("eel zi"), [self.eel])
+
+    def test_index_follows_edits_and_deletes(self):
+        self.moth.title = "Heron Risograph"
+        self.moth.save()
+        self.assertEqual(search_products("heron"), [self.moth])
+        self.moth.delete()
+        self.assertEqual(search_products("heron"), [])
+
+    def test_query_syntax_is_not_interpreted(self):
+        self.assertEqual(search_products('"moth* ('), [self.moth, self.eel])
+        self.assertEqual(search_products("***"), [])
+
+    def test_search_view(self):
+        response = self.client.get(reverse("shop:search"), {"q": "zine"})
+        self.assertContains(response, "Eel Zine")
+        self.assertNotContains(response, "Moth Risograph")
+
+
+# ============================
+# CATALOG CACHE
+# ============================
+class CatalogCacheTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.category = Category.objects.create(name="Prints")
+        self.product = make_product(self.category, 1)
+
+    def test_second_request_skips_the_database(self):
+        url = reverse("shop:product_detail", args=[self.product.slug])
+        self.client.get(url)
+        misses = catalog_cache.stats["misses"]
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertContains(response, "Print 1")
+        self.assertEqual(catalog_cache.stats["misses"], misses)
+        self.assertGreater(catalog_cache.stats["local_hits"], 0)
+
+    def test_shared_tier_serves_other_workers(self):
+        url = reverse("shop:shop_index")
+        self.client.get(url)
+        catalog_cache.clear_local()  # a fresh worker: empty LRU, same shared cache
+        with self.assertNumQueries(0):
+            self.client.get(url)
+        self.assertEqual(catalog_cache.stats["shared_hits"], 1)
+
+    def test_saving_catalog_models_bumps_version(self):
+        url = reverse("shop:product_detail", args=[self.product.slug])
+        self.client.get(url)
+
+        image = self.product.images.first()
+        image.width, image.height, image.dominant_color = 300, 200, "#c82828"
+        for obj in (self.product, image, self.category):
+            before = catalog_cache.version()
+            with self.captureOnCommitCallbacks(execute=True):
+                obj.save()
+            self.assertGreater(catalog_cache.version(), before)
+
+        self.product.title = "Renamed"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        self.assertContains(self.client.get(url), "Renamed")
+
+    def test_deleting_bumps_version(self):
+        before = catalog_cache.version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.images.first().delete()
+        self.assertGreater(catalog_cache.version(), before)
+
+    def test_lru_is_bounded(self):
+        small = type(catalog_cache)(max_entries=2)
+        for n in range(5):
+            small.get_or_set(f"k{n}", lambda: n)
+        self.assertEqual(small.snapshot()["local_entries"], 2)
+
+    def test_local_hits_skip_the_shared_cache(self):
+        catalog_cache.get_or_set("categories", lambda: ["Prints"])
+        shared = caches["default"]
+
+        with mock.patch.object(shared, "get", wraps=shared.get) as shared_get:
+            for _ in range(3):
+                self.assertEqual(catalog_cache.get("categories"), ["Prints"])
+
+        self.assertEqual(shared_get.call_count, 0)
+
+    def test_other_workers_see_a_bump_within_the_version_ttl(self):
+        worker = type(catalog_cache)(version_ttl=0.05)
+        before = worker.version()
+
+        catalog_cache.bump()
+        self.assertEqual(worker.version(), before)
+        time.sleep(0.06)
+        self.assertGreater(worker.version(), before)
+
+    def test_local_copies_expire_with_their_timeout(self):
+        catalog_cache.set("page:/shop/", "html", timeout=60)
+        other = type(catalog_cache)()
+        self.assertEqual(other.get("page:/shop/"), "html")  # copied from the shared tier
+
+        later = time.time() + 61
+        with mock.patch("shop.cache.time.time", return_value=later):
+            self.assertIsNone(catalog_cache.get("page:/shop/"))
+            self.assertIsNone(other.get("page:/shop/"))
+        self.assertEqual(catalog_cache.snapshot()["local_entries"], 0)
+
+    def test_stats_are_staff_only(self):
+        url = reverse("shop:catalog_cache_stats")
+        self.client.force_login(User.objects.create_user("buyer", password="pw"))
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+        self.client.force_login(User.objects.create_user("staff", password="pw", is_staff=True))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("local_entries", response.json())
+
+
+# ============================
+# ANONYMOUS PAGE CACHE
+# ============================
+class AnonymousPageCacheTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product(Category.objects.create(name="Prints"), 1)
+        self.url = reverse("shop:product_detail", args=[self.product.slug])
+
+    def test_hit_skips_rendering_and_queries(self):
+        self.assertEqual(self.client.get(self.url)["X-Page-Cache"], "miss")
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response["X-Page-Cache"], "hit")
+        self.assertEqual(response.templates, [])
+        self.assertContains(response, "Print 1")
+
+    def test_home_page_is_cached(self):
+        self.client.get(reverse("pages:home"))
+        self.assertEqual(self.client.get(reverse("pages:home"))["X-Page-Cache"], "hit")
+
+    def test_cached_form_gets_a_working_csrf_token(self):
+        self.client.get(self.url)
+
+        visitor = Client(enforce_csrf_checks=True)
+        response = visitor.get(self.url)
+        self.assertEqual(response["X-Page-Cache"], "hit")
+        token = re.search(r'name="csrfmiddlewaretoken" value="([^"]+)"', response.content.decode())
+        response = visitor.post(
+            reverse("shop:add_to_cart", args=[self.product.pk]),
+            {"csrfmiddlewaretoken": token.group(1)},
+        )
+        self.assertEqual(response.status_code, 302)
+
+    def test_logged_in_users_bypass(self):
+        self.client.get(self.url)
+        self.client.force_login(User.objects.create_user("buyer", password="pw"))
+        self.assertNotIn("X-Page-Cache", self.client.get(self.url))
+
+    def test_guest_with_cart_bypasses(self):
+        self.client.get(self.url)
+        self.client.post(reverse("shop:add_to_cart", args=[self.product.pk]))
+        self.assertNotIn("X-Page-Cache", self.client.get(self.url))
+
+    def test_catalog_change_invalidates(self):
+        self.client.get(self.url)
+        self.product.title = "Reprinted"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.save()
+        response = self.client.get(self.url)
+        self.assertEqual(response["X-Page-Cache"], "miss")
+        self.assertContains(response, "Reprinted")
+
+
+# ============================
+# CONDITIONAL GET
+# ============================
+class ProductConditionalGetTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product(Category.objects.create(name="Prints"), 1)
+        self.url = reverse("shop:product_detail", args=[self.product.slug])
+
+    def test_if_none_match_answers_304_with_one_query(self):
+        etag = self.client.get(self.url)["ETag"]
+        cache.clear()
+        catalog_cache.clear_local()
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get(self.url)["Last-Modified"]
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_image_delete_changes_validators(self):
+        before = Product.page_validators(self.product.slug)
+        self.product.images.first().delete()
+        after = Product.page_validators(self.product.slug)
+        self.assertNotEqual(before[0], after[0])
+        self.assertGreaterEqual(after[1], before[1])
+
+    def test_new_release_does_not_revalidate_old_html(self):
+        with override_settings(PAGE_CACHE_PREFIX="release-1"):
+            response = self.client.get(self.url)
+        etag, last_modified = response["ETag"], response["Last-Modified"]
+
+        with override_settings(PAGE_CACHE_PREFIX="release-2"):
+            self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+            # A process started for the new release floors Last-Modified
+            cache.clear()
+            catalog_cache.clear_local()
+            with mock.patch("shop.views.STARTED_AT", timezone.now() + timedelta(minutes=1)):
+                response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, 200)
+
+    def test_logged_in_page_is_never_a_304(self):
+        etag = self.client.get(self.url)["ETag"]
+        self.client.force_login(User.objects.create_user("buyer", password="pw"))
+
+        first = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("shop:add_to_cart", args=[self.product.pk]))
+        second = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
+        self.assertFalse(second.has_header("ETag"))
+        self.assertContains(second, '<span id="cart-count" class="cart-count">1</span>', html=True)
+
+    def test_guest_with_a_cart_is_never_a_304(self):
+        etag = self.client.get(self.url)["ETag"]
+        self.client.post(reverse("shop:add_to_cart", args=[self.product.pk]))
+
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_missing_product_still_404s(self):
+        response = self.client.get(reverse("shop:product_detail", args=["nope"]))
+        self.assertEqual(response.status_code, 404)
+
+
+# ============================
+# IMAGE DERIVATIVES
+# ============================
+class ImageDerivativeTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = Product.objects.create(
+            title="Heron", category=Category.objects.create(name="Prints"), price="30.00",
+        )
+        self.client.force_login(User.objects.create_user("staff", password="pw"))
+
+    def upload(self, **kwargs):
+        self.client.post(
+            reverse("shop:upload_product_image", args=[self.product.pk]),
+            {"images": [make_upload(**kwargs)]},
+        )
+        return self.product.images.get()
+
+    def test_upload_builds_webp_and_jpeg_without_upscaling(self):
+        image = self.upload()
+        self.assertEqual(set(image.derivatives), {"webp", "jpeg"})
+        self.assertEqual(list(image.derivatives["webp"]), ["320", "640", "1024"])
+
+        storage = image.image.storage
+        with storage.open(image.derivatives["webp"]["640"]) as fh:
+            derived = Image.open(fh)
+            self.assertEqual((derived.format, derived.width), ("WEBP", 640))
+
+    def test_transparent_png_flattens_for_jpeg(self):
+        image = self.upload(name="cut.png", size=(500, 500), mode="RGBA", fmt="PNG")
+        self.assertEqual(list(image.derivatives["jpeg"]), ["320"])
+
+    def test_detail_page_emits_srcset(self):
+        image = self.upload()
+        self.client.logout()
+        response = self.client.get(reverse("shop:product_detail", args=[self.product.slug]))
+        self.assertContains(response, 'type="image/webp"')
+        self.assertContains(response, f"{image.image.storage.url(image.derivatives['jpeg']['320'])} 320w")
+
+    def test_backfill_command(self):
+        image = ProductImage.objects.create(product=self.product, image=make_upload())
+        self.assertEqual(image.derivatives, {})
+        out = StringIO()
+        call_command("build_image_derivatives", stdout=out)
+        image.refresh_from_db()
+        self.assertIn("640", image.derivatives["jpeg"])
+        self.assertIn("Built derivatives for 1 image(s)", out.getvalue())
+
+    def test_delete_removes_derivative_files(self):
+        image = self.upload()
+        name = image.derivatives["webp"]["320"]
+        with self.captureOnCommitCallbacks(execute=True):
+            image.delete()
+        self.assertFalse(image.image.storage.exists(name))
+
+
+# ============================
+# IMAGE METADATA
+# ============================
+class ImageMetadataTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = Product.objects.create(
+            title="Heron", category=Category.objects.create(name="Prints"), price="30.00",
+        )
+
+    def test_computed_once_on_save(self):
+        image = ProductImage.objects.create(product=self.product, image=make_upload(size=(300, 200)))
+        self.assertEqual((image.width, image.height), (300, 200))
+        self.assertEqual(image.dominant_color, "#c82828")
+        self.assertTrue(image.placeholder.startswith("data:image/jpeg;base64,"))
+        # the upload was rewound after reading, so the stored file is complete
+        with image.image.storage.open(image.image.name) as fh:
+            self.assertEqual(Image.open(fh).size, (300, 200))
+
+    def test_only_a_new_file_is_measured_again(self):
+        image = ProductImage.objects.create(product=self.product, image=make_upload(size=(300, 200)))
+        image = ProductImage.objects.get(pk=image.pk)
+
+        with mock.patch("shop.models.read_metadata") as read:
+            image.position = 3
+            image.save()
+        read.assert_not_called()
+
+        image.image = image.image.storage.save("products/other.jpg", make_upload(size=(120, 90)))
+        image.save()
+        self.assertEqual((image.width, image.height), (120, 90))
+
+    def test_card_markup_reserves_space(self):
+        ProductImage.objects.create(product=self.product, image=make_upload(size=(300, 200)))
+        response = self.client.get(reverse("shop:shop_index"))
+        self.assertContains(response, 'width="300" height="200"')
+        self.assertContains(response, 'loading="lazy"')
+        self.assertContains(response, "url('data:image/jpeg;base64,")
+
+    def test_missing_file_is_skipped(self):
+        with self.assertLogs("shop.images", "WARNING") as logs:
+            image = ProductImage.objects.create(product=self.product, image="products/gone.jpg")
+        self.assertIsNone(image.width)
+        self.assertIn("products/gone.jpg", logs.output[0])
+
+    def test_parallel_backfill(self):
+        storage = ProductImage._meta.get_field("image").storage
+        names = [storage.save(f"products/old-{n}.jpg", make_upload(size=(40 + n, 30))) for n in range(4)]
+        ProductImage.objects.bulk_create(
+            ProductImage(product=self.product, image=name) for name in names + ["products/gone.jpg"]
+        )
+        out = StringIO()
+        call_command("build_image_metadata", workers=2, stdout=out)
+        self.assertEqual(
+            sorted(ProductImage.objects.exclude(width=None).values_list("width", flat=True)),
+            [40, 41, 42, 43],
+        )
+        self.assertIn("Updated 4 image(s) with 2 worker(s); 1 unreadable.", out.getvalue())
+
+
+# ============================
+# CONTENT-ADDRESSED MEDIA
+# ============================
+class ContentAddressedStorageTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Prints")
+        self.first = Product.objects.create(title="Heron", category=category, price="30.00")
+        self.second = Product.objects.create(title="Heron II", category=category, price="30.00")
+        self.client.force_login(User.objects.create_user("staff", password="pw"))
+
+    def upload(self, product, **kwargs):
+        self.client.post(
+            reverse("shop:upload_product_image", args=[product.pk]),
+            {"images": [make_upload(**kwargs)]},
+        )
+        return product.images.latest("pk")
+
+    def media_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(root, f), self.media_root)
+            for root, _, files in os.walk(self.media_root) for f in files
+        )
+
+    def test_identical_uploads_share_one_file(self):
+        a = self.upload(self.first, name="heron.jpg")
+        b = self.upload(self.second, name="heron-final-v2.JPG")
+        self.assertEqual(a.image.name, b.image.name)
+        self.assertRegex(a.image.name, r"^products/[0-9a-f]{2}/[0-9a-f]{64}\.jpg$")
+        self.assertEqual(a.derivatives, b.derivatives)
+        originals = [f for f in self.media_files() if "derivatives" not in f]
+        self.assertEqual(len(originals), 1)
+
+    def test_file_removed_with_last_reference(self):
+        a = self.upload(self.first)
+        b = self.upload(self.second)
+        storage = a.image.storage
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse("shop:delete_product_image", args=[a.pk]))
+        self.assertTrue(storage.exists(b.image.name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("shop:bulk_delete"), {"selected_products[]": [self.second.pk]})
+        self.assertFalse(Product.objects.filter(pk=self.second.pk).exists())
+        self.assertEqual(self.media_files(), [])
+
+    def test_duplicate_copies_rows_not_files(self):
+        self.upload(self.first)
+        ProductVariant.objects.create(product=self.first, name="A3")
+        before = self.media_files()
+
+        self.client.get(reverse("shop:duplicate_product", args=[self.first.pk]))
+        self.client.get(reverse("shop:duplicate_product", args=[self.first.pk]))
+
+        copies = Product.objects.filter(slug__startswith="heron-copy").order_by("pk")
+        self.assertEqual([p.slug for p in copies], ["heron-copy", "heron-copy-2"])
+        for copy in copies:
+            self.assertEqual(copy.images.get().image.name, self.first.images.get().image.name)
+            self.assertEqual(copy.variants.get().name, "A3")
+        self.assertEqual(self.media_files(), before)
+
+
+# ============================
+# MEDIA SERVING
+# ============================
+class MediaServingTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.body = bytes(range(256)) * 40
+        self.name = "products/ab/" + "ab" * 32 + ".jpg"
+        os.makedirs(os.path.join(self.media_root, "products/ab"))
+        with open(os.path.join(self.media_root, self.name), "wb") as fh:
+            fh.write(self.body)
+        self.url = "/media/" + self.name
+
+    def test_hashed_names_are_immutable_with_strong_etag(self):
+        response = self.client.get(self.url)
+        self.assertEqual(b"".join(response.streaming_content), self.body)
+        self.assertEqual(response["ETag"], '"' + "ab" * 32 + '"')
+        self.assertIn("immutable", response["Cache-Control"])
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_range_requests(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=10-19")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(self.body)}")
+        self.assertEqual(b"".join(response.streaming_content), self.body[10:20])
+
+        response = self.client.get(self.url, HTTP_RANGE="bytes=-5")
+        self.assertEqual(b"".join(response.streaming_content), self.body[-5:])
+
+        response = self.client.get(self.url, HTTP_RANGE=f"bytes={len(self.body)}-")
+        self.assertEqual(response.status_code, 416)
+
+        # A stale If-Range gets the whole, current file
+        response = self.client.get(self.url, HTTP_RANGE="bytes=0-9", HTTP_IF_RANGE='"old"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_range_past_the_end_is_416(self):
+        response = self.client.get(self.url, HTTP_RANGE=f"bytes={len(self.body) + 5}-{len(self.body) + 9}")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(self.body)}")
+
+    def test_reversed_range_is_ignored(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=5-2")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.body)
+
+    def test_path_traversal_is_404(self):
+        self.assertEqual(self.client.get("/media/../config/settings.py").status_code, 404)
+        self.assertEqual(self.client.get("/media/products/missing.jpg").status_code, 404)
+
+    @override_settings(MEDIA_ACCEL_REDIRECT="/protected-media/")
+    def test_accel_redirect_offload(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response["X-Accel-Redirect"], "/protected-media/" + self.name)
+        self.assertEqual(response.content, b"")
+
+
+# ============================
+# CART TOTALS
+# ============================
+class CartTotalsTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Prints")
+        self.products = [
+            Product.objects.create(title=f"Print {n}", category=category, price=f"{n + 1}.50")
+            for n in range(12)
+        ]
+
+    def cart_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse("shop:cart"))
+        return response, len(ctx.captured_queries)
+
+    def test_user_cart_query_count_is_constant(self):
+        user = User.objects.create_user("buyer", password="pw")
+        self.client.force_login(user)
+        cart = Cart.objects.create(user=user)
+        CartItem.objects.create(cart=cart, product=self.products[0], quantity=2)
+        _, small = self.cart_queries()
+
+        for product in self.products[1:]:
+            CartItem.objects.create(cart=cart, product=product, quantity=3)
+        cache.delete(cart_count_key(user.pk))  # as cart_changed() would on commit
+        response, large = self.cart_queries()
+
+        self.assertEqual(small, large)
+        expected = 2 * Decimal("1.50") + sum(3 * p.price for p in Product.objects.all()[1:])
+        self.assertEqual(response.context["total"], expected)
+        self.assertContains(response, "£7.50")  # Print 1: 3 x 2.50
+        self.assertEqual(response.context["items"][0].total_price, Decimal("3.00"))
+
+    def test_guest_cart_reprices_in_bulk(self):
+        for product in self.products[:2]:
+            self.client.post(reverse("shop:add_to_cart", args=[product.pk]))
+        _, small = self.cart_queries()
+
+        for product in self.products[2:]:
+            self.client.post(reverse("shop:add_to_cart", args=[product.pk]))
+        Product.objects.filter(pk=self.products[0].pk).update(price="99.00")
+        response, large = self.cart_queries()
+
+        self.assertEqual(small, large)
+        self.assertEqual(
+            response.context["total"],
+            Decimal("99.00") + sum(p.price for p in Product.objects.exclude(pk=self.products[0].pk)),
+        )
+
+
+# ============================
+# ADD TO CART
+# ============================
+class AddToCartTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = Product.objects.create(
+            title="Heron", category=Category.objects.create(name="Prints"), price="30.00",
+        )
+        self.user = User.objects.create_user("buyer", password="pw")
+        self.client.force_login(self.user)
+
+    def test_increment_is_a_single_statement(self):
+        self.client.post(reverse("shop:add_to_cart", args=[self.product.pk]))
+        cart = Cart.objects.get(user=self.user)
+        with self.assertNumQueries(1):
+            CartItem.objects.add(cart.id, self.product.id)
+        self.assertEqual(CartItem.objects.get().quantity, 2)
+
+
+def race(targets):
+    """Start every target in its own thread at once; return (results, errors).
+
+    SQLite serialises writers with a lock instead of waiting; a locked
+    attempt rolled back, so the target is simply run again."""
+    start = threading.Barrier(len(targets))
+    results, errors = [], []
+
+    def worker(target):
+        try:
+            start.wait()
+            while True:
+                try:
+                    results.append(target())
+                    break
+                except OperationalError:
+                    time.sleep(0.001)
+        except Exception as exc:  # surfaced by the caller
+            errors.append(exc)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=worker, args=(target,)) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+class ConcurrentAddToCartTests(ShopTransactionTestCase):
+    THREADS = 8
+    ADDS = 10
+
+    def test_parallel_adds_lose_no_increments(self):
+        product = Product.objects.create(
+            title="Heron", category=Category.objects.create(name="Prints"), price="30.00",
+        )
+        cart = Cart.objects.create(user=User.objects.create_user("buyer"))
+
+        _, errors = race([lambda: CartItem.objects.add(cart.id, product.id)] * (self.THREADS * self.ADDS))
+
+        self.assertEqual(errors, [])
+        self.assertEqual(CartItem.objects.get().quantity, self.THREADS * self.ADDS)
+
+
+# ============================
+# JSON CART API
+# ============================
+class CartApiTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Prints")
+        self.products = [
+            Product.objects.create(title=f"Print {n}", category=category, price="10.00")
+            for n in range(6)
+        ]
+
+    def post(self, name, data):
+        return self.client.post(reverse(name), json.dumps(data), content_type="application/json")
+
+    def batch(self, changes):
+        return self.post("shop:api_cart_batch", {
+            "lines": [{"product_id": p.pk, "quantity": q} for p, q in changes],
+        })
+
+    def test_guest_add_and_batch(self):
+        self.post("shop:api_cart_add", {"product_id": self.products[0].pk, "quantity": 2})
+        response = self.batch([(self.products[0], 0), (self.products[1], 3), (self.products[2], 1)])
+        data = response.json()
+        self.assertEqual([line["product_id"] for line in data["lines"]], [self.products[1].pk, self.products[2].pk])
+        self.assertEqual((data["count"], data["total"]), (4, "40.00"))
+
+    def test_user_batch_is_constant_queries(self):
+        self.client.force_login(User.objects.create_user("buyer", password="pw"))
+        self.batch([(self.products[0], 1)])
+
+        with CaptureQueriesContext(connection) as small:
+            self.batch([(self.products[0], 2), (self.products[5], 0)])
+        with CaptureQueriesContext(connection) as large:
+            response = self.batch([(p, 5) for p in self.products[1:]] + [(self.products[0], 0)])
+
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(response.json()["total"], "250.00")
+        self.assertEqual(CartItem.objects.count(), 5)
+
+    def test_unknown_product_changes_nothing(self):
+        self.client.force_login(User.objects.create_user("buyer", password="pw"))
+        self.batch([(self.products[0], 1)])
+        response = self.post("shop:api_cart_batch", {"lines": [
+            {"product_id": self.products[0].pk, "quantity": 9},
+            {"product_id": 999999, "quantity": 1},
+        ]})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()["product_ids"], [999999])
+        self.assertEqual(CartItem.objects.get().quantity, 1)
+
+    def test_bad_payloads(self):
+        for body in ("not json", json.dumps({"lines": [{"product_id": 1, "quantity": -1}]}), json.dumps([])):
+            response = self.client.post(reverse("shop:api_cart_batch"), body, content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(reverse("shop:api_cart_batch")).status_code, 405)
+
+    def test_csrf_is_enforced(self):
+        client = Client(enforce_csrf_checks=True)
+        response = client.post(reverse("shop:api_cart_add"), json.dumps({"product_id": self.products[0].pk}),
+                               content_type="application/json")
+        self.assertEqual(response.status_code, 403)
+
+
+# ============================
+# LOGIN CART MERGE
+# ============================
+class LoginCartMergeTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Prints")
+        self.products = [
+            Product.objects.create(title=f"Print {n}", category=category, price="10.00")
+            for n in range(20)
+        ]
+        self.user = User.objects.create_user("buyer", password="pw")
+
+    def guest_adds(self, products):
+        for product in products:
+            self.client.post(reverse("shop:add_to_cart", args=[product.pk]))
+
+    def login(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.post(reverse("login"), {"username": "buyer", "password": "pw"})
+        return len([q for q in ctx.captured_queries if "shop_" in q["sql"]])
+
+    def test_merges_into_existing_lines_and_clears_session(self):
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.products[0], quantity=2)
+        self.guest_adds([self.products[0], self.products[1]])
+
+        self.login()
+
+        quantities = dict(CartItem.objects.values_list("product_id", "quantity"))
+        self.assertEqual(quantities, {self.products[0].pk: 3, self.products[1].pk: 1})
+        self.assertNotIn("cart", self.client.session)
+
+    def test_query_count_does_not_grow_with_cart(self):
+        Cart.objects.create(user=self.user)
+        self.guest_adds(self.products[:2])
+        small = self.login()
+        self.client.logout()
+        CartItem.objects.all().delete()
+
+        self.guest_adds(self.products[2:])
+        self.assertEqual(self.login(), small)
+        self.assertEqual(CartItem.objects.count(), 18)
+
+
+# ============================
+# SESSION CART FORMAT
+# ============================
+class SessionCartFormatTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Prints")
+        self.product = Product.objects.create(title="Moth", category=category, price="12.50")
+        self.request = RequestFactory().get("/")
+        self.request.session = SessionStore()
+
+    def test_stores_ids_and_quantities_only(self):
+        self.client.post(reverse("shop:add_to_cart", args=[self.product.pk]))
+        self.client.post(reverse("shop:add_to_cart", args=[self.product.pk]))
+
+        self.assertEqual(self.client.session["cart"], {"v": 1, "lines": {str(self.product.pk): 2}})
+
+    def test_prices_are_read_from_the_product(self):
+        self.client.post(reverse("shop:add_to_cart", args=[self.product.pk]))
+        Product.objects.filter(pk=self.product.pk).update(price="20.00")
+
+        response = self.client.get(reverse("shop:cart"))
+
+        self.assertEqual(response.context["total"], Decimal("20.00"))
+
+    def test_reads_the_old_unversioned_format(self):
+        self.request.session["cart"] = {str(self.product.pk): {"title": "Moth", "price": 9.0, "quantity": 3}}
+
+        self.assertEqual(get_session_cart(self.request), {str(self.product.pk): 3})
+
+    def test_unchanged_cart_does_not_touch_the_session(self):
+        save_session_cart(self.request, {str(self.product.pk): 1})
+        self.request.session.save()
+        self.request.session.modified = False
+
+        save_session_cart(self.request, get_session_cart(self.request))
+        self.assertFalse(self.request.session.modified)
+
+        save_session_cart(self.request, {})
+        self.assertTrue(self.request.session.modified)
+        self.assertNotIn("cart", self.request.session)
+
+
+# ============================
+# CART COUNT BADGE
+# ============================
+class CartCountTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Prints")
+        self.product = Product.objects.create(title="Moth", category=category, price="12.50")
+        self.user = User.objects.create_user("buyer", password="pw")
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        cart_queries = [q for q in ctx.captured_queries if "shop_cartitem" in q["sql"]]
+        return response, len(cart_queries)
+
+    def test_pages_without_the_badge_skip_the_count(self):
+        self.client.login(username="buyer", password="pw")
+        response, cart_queries = self.get(reverse("pages:home"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(cart_queries, 0)
+
+    def test_user_count_is_cached_and_refreshed_on_change(self):
+        self.client.login(username="buyer", password="pw")
+        url = reverse("shop:shop_index")
+
+        response, cart_queries = self.get(url)
+        self.assertEqual(cart_queries, 1)
+        self.assertNotContains(response, 'id="cart-count" class="cart-count">')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("shop:add_to_cart", args=[self.product.pk]))
+            self.client.post(reverse("shop:add_to_cart", args=[self.product.pk]))
+
+        response, cart_queries = self.get(url)
+        self.assertEqual(cart_queries, 1)
+        self.assertContains(response, 'id="cart-count" class="cart-count">2</span>')
+
+        response, cart_queries = self.get(url)
+        self.assertEqual(cart_queries, 0)
+        self.assertContains(response, 'id="cart-count" class="cart-count">2</span>')
+
+    def test_guest_count_comes_from_the_session(self):
+        self.client.post(reverse("shop:add_to_cart", args=[self.product.pk]))
+
+        response, cart_queries = self.get(reverse("shop:shop_index"))
+
+        self.assertEqual(cart_queries, 0)
+        self.assertContains(response, 'id="cart-count" class="cart-count">1</span>')
+
+
+# ============================
+# PURGE STALE STATE
+# ============================
+class PurgeStaleShopStateTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Prints")
+        product = Product.objects.create(title="Moth", category=category, price="12.50")
+        now = timezone.now()
+
+        for n in range(5):
+            Session.objects.create(session_key=f"old{n}", session_data="", expire_date=now - timedelta(days=1))
+        Session.objects.create(session_key="live", session_data="", expire_date=now + timedelta(days=1))
+
+        self.carts = []
+        for n in range(4):
+            cart = Cart.objects.create(user=User.objects.create_user(f"user{n}"))
+            CartItem.objects.create(cart=cart, product=product)
+            self.carts.append(cart)
+        Cart.objects.filter(pk__in=[c.pk for c in self.carts[:3]]).update(updated_at=now - timedelta(days=40))
+
+    def purge(self, *args):
+        out = StringIO()
+        call_command("purge_stale_shop_state", "--batch-size", "2", *args, stdout=out)
+        return out.getvalue()
+
+    def test_deletes_expired_sessions_and_idle_carts_in_batches(self):
+        with CaptureQueriesContext(connection) as ctx:
+            output = self.purge()
+
+        self.assertEqual(list(Session.objects.values_list("session_key", flat=True)), ["live"])
+        self.assertEqual(list(Cart.objects.values_list("pk", flat=True)), [self.carts[3].pk])
+        self.assertEqual(CartItem.objects.count(), 1)
+        self.assertIn("sessions: deleted 5 row(s)", output)
+        self.assertIn("carts: deleted 6 row(s) (shop.Cart 3, shop.CartItem 3)", output)
+        self.assertIn("rows/s", output)
+        # Three session batches and two cart batches, never one big DELETE
+        session_deletes = [q for q in ctx.captured_queries if q["sql"].startswith('DELETE FROM "django_session"')]
+        self.assertEqual(len(session_deletes), 3)
+
+    def test_dry_run_deletes_nothing(self):
+        output = self.purge("--dry-run")
+
+        self.assertEqual(Session.objects.count(), 6)
+        self.assertEqual(Cart.objects.count(), 4)
+        self.assertIn("sessions: would delete 5 row(s)", output)
+        # Same figures as a real run, cascaded cart lines included
+        self.assertIn("carts: would delete 6 row(s) (shop.Cart 3, shop.CartItem 3)", output)
+
+    def test_cart_age_is_configurable(self):
+        self.purge("--cart-days", "60")
+
+        self.assertEqual(Cart.objects.count(), 4)
+
+
+# ============================
+# STRIPE (against the local stub server)
+# ============================
+WEBHOOK_SECRET = "whsec_test"
+
+
+def checkout_line(product, quantity=1, variant=None, tagged=True):
+    """One line_items entry as create_checkout_session builds it."""
+    metadata = {"product_id": str(product.pk)} if tagged else {}
+    if variant:
+        metadata["variant_id"] = str(variant.pk)
+    return {
+        "price_data": {
+            "currency": "gbp",
+            "product_data": {"name": product.title, "metadata": metadata},
+            "unit_amount": int(Decimal(product.price) * 100),
+        },
+        "quantity": quantity,
+    }
+
+
+class StripeStubTestCase(ShopTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub = StripeStub(webhook_secret=WEBHOOK_SECRET).start()
+        cls.addClassCleanup(cls.stub.stop)
+
+    def setUp(self):
+        super().setUp()
+        self.stub.requests.clear()
+        self.stub.sessions.clear()
+        self.stub.fail_next = 0
+        self.stub.latency = 0
+        self.stub.page_size = 100
+        override = override_settings(
+            STRIPE_API_BASE=self.stub.url,
+            STRIPE_SECRET_KEY="sk_test",
+            STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET,
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def stub_session(self, lines, user=None):
+        metadata = {"user_id": str(user.pk)} if user else {}
+        return self.stub.create_session({"mode": "payment", "line_items": lines, "metadata": metadata})["id"]
+
+    def post_event(self, event):
+        body = json.dumps(event).encode()
+        return self.client.post(
+            reverse("shop:stripe_webhook"), body, content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=sign(body, WEBHOOK_SECRET),
+        )
+
+
+class StripeWebhookTests(StripeStubTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Prints")
+        self.product = Product.objects.create(title="Moth", category=category, price="25.00")
+        self.user = User.objects.create_user("buyer", password="pw")
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product)
+
+    def completed(self, lines=None, user=None):
+        session_id = self.stub_session(lines or [checkout_line(self.product)], user)
+        return self.stub.completed_event(session_id)
+
+    def test_webhook_only_stores_the_event(self):
+        response = self.post_event(self.completed(user=self.user))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(StripeEvent.objects.get().status, StripeEvent.PENDING)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.stub.requests, [])
+
+    def test_bad_signature_is_rejected(self):
+        response = self.client.post(
+            reverse("shop:stripe_webhook"), json.dumps(self.completed()),
+            content_type="application/json", HTTP_STRIPE_SIGNATURE="t=1,v1=bad",
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(StripeEvent.objects.exists())
+
+    def test_retried_event_creates_one_order(self):
+        event = self.completed(user=self.user)
+        for _ in range(3):
+            self.assertEqual(self.post_event(event).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(process_pending(), (1, 0))
+            self.assertEqual(process_pending(), (0, 0))
+
+        order = Order.objects.get()
+        self.assertEqual(order.user, self.user)
+        self.assertEqual(order.total_price, Decimal("25.00"))
+        self.assertEqual(order.items.get().product, self.product)
+        self.assertFalse(Cart.objects.filter(user=self.user).exists())
+        self.assertEqual(EmailOutbox.objects.get().key, f"order-confirmation:{order.pk}")
+        self.assertEqual(StripeEvent.objects.get().status, StripeEvent.PROCESSED)
+
+    def test_guest_checkout_creates_an_order(self):
+        self.post_event(self.completed())
+        process_pending()
+
+        self.assertIsNone(Order.objects.get().user)
+
+    def make_due(self):
+        StripeEvent.objects.update(next_attempt_at=timezone.now())
+
+    def test_failure_waits_out_a_growing_backoff(self):
+        self.post_event(self.completed())
+        self.stub.fail_next = 10 ** 6
+
+        waits = []
+        with override_settings(STRIPE_MAX_RETRIES=0), self.assertLogs("shop.webhooks", "ERROR"):
+            for _ in range(3):
+                self.assertEqual(process_pending(), (0, 1))
+                # Not picked up again straight away
+                self.assertEqual(process_pending(), (0, 0))
+                waits.append(StripeEvent.objects.get().next_attempt_at - timezone.now())
+                self.make_due()
+
+        self.assertTrue(waits[0] < waits[1] < waits[2])
+        self.assertEqual(StripeEvent.objects.get().status, StripeEvent.PENDING)
+
+    def test_parked_events_can_be_requeued(self):
+        self.post_event(self.completed())
+        self.stub.fail_next = 10 ** 6
+
+        with override_settings(STRIPE_MAX_RETRIES=0), self.assertLogs("shop.webhooks", "ERROR"):
+            for _ in range(MAX_ATTEMPTS):
+                self.assertEqual(process_pending(), (0, 1))
+                self.make_due()
+
+        event = StripeEvent.objects.get()
+        self.assertEqual(event.status, StripeEvent.FAILED)
+        self.assertIn("Stub outage", event.last_error)
+        self.assertFalse(Order.objects.exists())
+
+        # Stripe is back: requeue and the paid checkout becomes an order
+        self.stub.fail_next = 0
+        out = StringIO()
+        call_command("process_stripe_events", "--once", "--requeue-failed", stdout=out)
+
+        self.assertIn("Requeued 1 failed event(s).", out.getvalue())
+        self.assertEqual(StripeEvent.objects.get().status, StripeEvent.PROCESSED)
+        self.assertTrue(Order.objects.exists())
+
+    def test_line_items_resolve_by_id_in_constant_queries(self):
+        category = self.product.category
+        # Same title twice: only the ids tell them apart
+        products = [
+            Product.objects.create(title="Moth", slug=f"moth-{n}", category=category, price="5.00")
+            for n in range(12)
+        ]
+        variant = ProductVariant.objects.create(product=products[0], name="A3")
+        self.stub.page_size = 5
+        self.post_event(self.completed(
+            [checkout_line(products[0], 2, variant)] + [checkout_line(p) for p in products[1:]]
+        ))
+
+        with CaptureQueriesContext(connection) as ctx:
+            process_pending()
+
+        order = Order.objects.get()
+        self.assertEqual(sorted(order.items.values_list("product_id", flat=True)), [p.pk for p in products])
+        first = order.items.get(product=products[0])
+        self.assertEqual((first.quantity, first.variant), (2, variant))
+        inserts = [q for q in ctx.captured_queries if q["sql"].startswith('INSERT INTO "shop_orderitem"')]
+        self.assertEqual(len(inserts), 1)
+        lookups = [q for q in ctx.captured_queries if 'FROM "shop_product"' in q["sql"]]
+        self.assertEqual(len(lookups), 1)
+        # Twelve lines in pages of five
+        self.assertEqual(len(self.stub.requests), 3)
+
+    def test_untagged_lines_fall_back_to_the_title(self):
+        self.post_event(self.completed([checkout_line(self.product, tagged=False)]))
+        process_pending()
+
+        self.assertEqual(Order.objects.get().items.get().product, self.product)
+
+    def test_lines_snapshot_what_was_charged(self):
+        variant = ProductVariant.objects.create(product=self.product, name="A3", price_adjust="5.00")
+        line = checkout_line(self.product, 2, variant)
+        line["price_data"]["unit_amount"] = 3000
+        self.post_event(self.completed([line]))
+        process_pending()
+
+        # Later catalogue edits don't rewrite the order
+        Product.objects.filter(pk=self.product.pk).update(title="Moth (reprint)", price="99.00")
+        item = Order.objects.get().items.get()
+        self.assertEqual((item.title, item.variant_name), ("Moth", "A3"))
+        self.assertEqual((item.unit_price, item.line_total), (Decimal("30.00"), Decimal("60.00")))
+        self.assertIn("Moth (A3) × 2 — £60.00", EmailOutbox.objects.get().body)
+
+    def test_unknown_product_line_is_still_recorded(self):
+        line = checkout_line(self.product)
+        line["price_data"]["product_data"]["metadata"] = {"product_id": "999999"}
+        self.post_event(self.completed([line]))
+        with self.assertLogs("shop.webhooks", "WARNING"):
+            process_pending()
+
+        item = Order.objects.get().items.get()
+        self.assertIsNone(item.product)
+        self.assertEqual((item.title, item.line_total), ("Moth", Decimal("25.00")))
+
+    def held_session(self, quantity=2):
+        reference, _ = reserve([(self.product.pk, None, quantity)])
+        session_id = self.stub.create_session({
+            "mode": "payment", "line_items": [checkout_line(self.product, quantity)],
+            "metadata": {"hold": reference},
+        })["id"]
+        return reference, session_id
+
+    def test_payment_turns_the_hold_into_a_sale(self):
+        reference, session_id = self.held_session()
+        self.post_event(self.stub.completed_event(session_id))
+        process_pending()
+
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.reserved), (8, 0))
+        self.assertFalse(StockHold.objects.filter(reference=reference).exists())
+
+    def test_expired_session_releases_the_hold(self):
+        _, session_id = self.held_session()
+        self.post_event({
+            "id": "evt_expired", "object": "event", "type": "checkout.session.expired",
+            "data": {"object": self.stub.sessions[session_id]["session"]},
+        })
+        process_pending()
+
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.reserved), (10, 0))
+        self.assertFalse(StockHold.objects.exists())
+        self.assertFalse(Order.objects.exists())
+
+
+class StripeClientTests(StripeStubTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Prints")
+        self.product = Product.objects.create(title="Moth", category=category, price="25.00")
+        self.user = User.objects.create_user("buyer", password="pw", email="buyer@example.com")
+        cart = Cart.objects.create(user=self.user)
+        CartItem.objects.create(cart=cart, product=self.product, quantity=2)
+        self.client.force_login(self.user)
+
+    def checkout(self):
+        return self.client.post(reverse("shop:create_checkout_session"))
+
+    def test_checkout_sends_product_ids_and_redirects(self):
+        response = self.checkout()
+
+        session = next(iter(self.stub.sessions.values()))
+        self.assertRedirects(response, session["session"]["url"], fetch_redirect_response=False)
+        line = session["line_items"][0]
+        self.assertEqual(line["price"]["product"]["metadata"], {"product_id": str(self.product.pk)})
+        self.assertEqual(line["quantity"], 2)
+
+    def test_checkout_holds_the_stock(self):
+        self.checkout()
+
+        session = next(iter(self.stub.sessions.values()))["session"]
+        hold = StockHold.objects.get()
+        self.assertEqual(session["metadata"]["hold"], hold.reference)
+        self.assertEqual(hold.quantity, 2)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.reserved), (10, 2))
+
+    def test_sold_out_print_goes_back_to_the_cart(self):
+        Product.objects.filter(pk=self.product.pk).update(stock=3, reserved=2)
+
+        response = self.checkout()
+
+        self.assertRedirects(response, reverse("shop:cart"), fetch_redirect_response=False)
+        self.assertEqual(self.stub.requests, [])
+        self.assertFalse(StockHold.objects.exists())
+
+    def test_retries_reuse_the_idempotency_key(self):
+        self.stub.fail_next = 1
+        self.checkout()
+
+        keys = [r["idempotency_key"] for r in self.stub.requests]
+        self.assertEqual(len(keys), 2)
+        self.assertEqual(keys[0], keys[1])
+        self.assertEqual(len(self.stub.sessions), 1)
+
+    def test_connection_is_reused_between_requests(self):
+        self.checkout()
+        self.checkout()
+
+        first, second = self.stub.requests
+        self.assertEqual(first["client_port"], second["client_port"])
+        self.assertNotEqual(first["idempotency_key"], second["idempotency_key"])
+        self.assertEqual(len(self.stub.sessions), 2)
+
+    @override_settings(STRIPE_READ_TIMEOUT=0.2, STRIPE_MAX_RETRIES=0)
+    def test_slow_stripe_times_out_back_to_the_cart(self):
+        self.stub.latency = 1.0
+        started = time.monotonic()
+
+        response = self.checkout()
+
+        self.assertLess(time.monotonic() - started, 0.9)
+        self.assertRedirects(response, reverse("shop:cart"), fetch_redirect_response=False)
+        # The hold taken for the failed checkout is given back
+        self.assertFalse(StockHold.objects.exists())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.reserved, 0)
+
+
+# ============================
+# EMAIL OUTBOX
+# ============================
+class EmailOutboxTests(ShopTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.smtp = SMTPStub(reject={"nobody@example.com"}).start()
+        cls.addClassCleanup(cls.smtp.stop)
+
+    def setUp(self):
+        super().setUp()
+        self.smtp.reset()
+        override = override_settings(DEFAULT_FROM_EMAIL="shop@example.com", **self.smtp.settings())
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def queue(self, *addresses):
+        for n, address in enumerate(addresses):
+            enqueue_email(address, f"Hello {n}", "emails/order_confirmation.txt", {"order": None, "items": []})
+
+    def test_batch_shares_one_smtp_connection(self):
+        self.queue(*[f"buyer{n}@example.com" for n in range(5)])
+
+        call_command("send_outbox", "--once", stdout=StringIO())
+
+        self.assertEqual(self.smtp.connections, 1)
+        self.assertEqual(sorted(m["to"][0] for m in self.smtp.messages), [f"buyer{n}@example.com" for n in range(5)])
+        self.assertEqual(self.smtp.messages[0]["message"]["From"], "shop@example.com")
+        self.assertEqual(EmailOutbox.objects.filter(status=EmailOutbox.SENT).count(), 5)
+
+    def test_refused_message_backs_off_without_blocking_the_batch(self):
+        self.queue("nobody@example.com", "buyer@example.com")
+
+        self.assertEqual(send_batch(), (1, 1))
+        refused = EmailOutbox.objects.get(to="nobody@example.com")
+        self.assertEqual((refused.status, refused.attempts), (EmailOutbox.PENDING, 1))
+        self.assertGreater(refused.next_attempt_at, timezone.now())
+        self.assertIn("SMTPRecipientsRefused", refused.last_error)
+
+        # Not due again until the backoff has passed
+        self.assertEqual(send_batch(), (0, 0))
+
+    def test_worker_dying_mid_batch_sends_nothing_twice(self):
+        self.queue(*[f"buyer{n}@example.com" for n in range(3)])
+        original = EmailBackend.send_messages
+        calls = []
+
+        def dies_on_second(backend, messages):
+            calls.append(messages)
+            if len(calls) == 2:
+                raise SystemExit("worker killed")
+            return original(backend, messages)
+
+        with mock.patch.object(EmailBackend, "send_messages", dies_on_second), self.assertRaises(SystemExit):
+            send_batch()
+
+        # What went out is recorded; the rest stay leased to the dead run
+        statuses = list(EmailOutbox.objects.order_by("pk").values_list("status", flat=True))
+        self.assertEqual(statuses, [EmailOutbox.SENT, EmailOutbox.SENDING, EmailOutbox.SENDING])
+        self.assertEqual(send_batch(), (0, 0))
+
+        # Once the lease runs out another run picks them up
+        EmailOutbox.objects.filter(status=EmailOutbox.SENDING).update(next_attempt_at=timezone.now())
+        self.assertEqual(send_batch(), (2, 0))
+        self.assertEqual(sorted(m["to"][0] for m in self.smtp.messages), [f"buyer{n}@example.com" for n in range(3)])
+
+    def test_email_that_keeps_killing_the_worker_is_given_up_on(self):
+        self.queue("buyer@example.com")
+
+        def dies(backend, messages):
+            raise SystemExit("worker killed")
+
+        with mock.patch.object(EmailBackend, "send_messages", dies):
+            # Each run that dies is charged when the next one takes the lease over
+            for _ in range(OUTBOX_MAX_ATTEMPTS):
+                with self.assertRaises(SystemExit):
+                    send_batch()
+                EmailOutbox.objects.update(next_attempt_at=timezone.now())
+            item = EmailOutbox.objects.get()
+            self.assertEqual((item.status, item.attempts), (EmailOutbox.SENDING, OUTBOX_MAX_ATTEMPTS - 1))
+
+            with self.assertLogs("shop.outbox", "ERROR"):
+                self.assertEqual(send_batch(), (0, 0))
+
+        item.refresh_from_db()
+        self.assertEqual((item.status, item.attempts), (EmailOutbox.FAILED, OUTBOX_MAX_ATTEMPTS))
+        self.assertIn("Lease expired", item.last_error)
+
+    def test_smtp_down_leaves_the_queue_alone(self):
+        self.queue("buyer@example.com")
+        with override_settings(EMAIL_PORT=closed_port()), self.assertLogs("shop.outbox", "WARNING"):
+            self.assertEqual(send_batch(), (0, 0))
+
+        item = EmailOutbox.objects.get()
+        self.assertEqual((item.status, item.attempts), (EmailOutbox.PENDING, 0))
+
+    def test_same_key_is_queued_once(self):
+        for _ in range(2):
+            enqueue_email("buyer@example.com", "Hi", "emails/order_confirmation.txt", {}, key="welcome:1")
+
+        self.assertEqual(EmailOutbox.objects.count(), 1)
+
+    def test_marking_an_order_shipped_queues_one_email(self):
+        self.client.force_login(User.objects.create_user("staff", password="pw"))
+        order = Order.objects.create(email="buyer@example.com", total_price="25.00")
+        url = reverse("shop:order_detail", args=[order.pk])
+
+        for _ in range(2):
+            self.client.post(url, {"status": "shipped"})
+
+        item = EmailOutbox.objects.get()
+        self.assertEqual(item.key, f"order-shipped:{order.pk}")
+        self.assertIn("on its way", item.body)
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# ============================
+# STOCK RESERVATIONS
+# ============================
+class StockReservationTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Prints")
+        self.moth = Product.objects.create(title="Moth", category=category, price="25.00", stock=3)
+        self.heron = Product.objects.create(title="Heron", category=category, price="30.00", stock=1)
+
+    def state(self, product):
+        product.refresh_from_db()
+        return product.stock, product.reserved
+
+    def test_reserve_holds_without_selling(self):
+        reference, _ = reserve([(self.moth.pk, None, 2), (self.heron.pk, None, 1)])
+
+        self.assertEqual(self.state(self.moth), (3, 2))
+        self.assertEqual(self.state(self.heron), (1, 1))
+        self.assertEqual(StockHold.objects.filter(reference=reference).count(), 2)
+
+    def test_reserve_is_all_or_nothing(self):
+        reserve([(self.heron.pk, None, 1)])
+
+        with self.assertRaises(OutOfStock) as ctx:
+            reserve([(self.moth.pk, None, 1), (self.heron.pk, None, 1)])
+
+        self.assertEqual(ctx.exception.keys, [(self.heron.pk, None)])
+        self.assertEqual(self.state(self.moth), (3, 0))
+        self.assertEqual(StockHold.objects.count(), 1)
+
+    def test_convert_sells_held_units(self):
+        reference, _ = reserve([(self.moth.pk, None, 2)])
+
+        self.assertEqual(convert(reference, [(self.moth.pk, None, 2)]), [])
+
+        self.assertEqual(self.state(self.moth), (1, 0))
+        self.assertFalse(StockHold.objects.exists())
+
+    def test_convert_after_the_hold_lapsed_sells_only_what_is_left(self):
+        reference, _ = reserve([(self.heron.pk, None, 1)])
+        StockHold.objects.update(expires_at=timezone.now() - timedelta(hours=1))
+        release_expired()
+        # Someone else buys the last one in the meantime
+        convert(reserve([(self.heron.pk, None, 1)])[0], [(self.heron.pk, None, 1)])
+
+        self.assertEqual(convert(reference, [(self.heron.pk, None, 1)]), [(self.heron.pk, None)])
+        self.assertEqual(self.state(self.heron), (0, 0))
+
+    def test_variant_lines_use_the_variant_stock(self):
+        variant = ProductVariant.objects.create(product=self.moth, name="A3", stock=1)
+        reference, _ = reserve([(self.moth.pk, variant.pk, 1)])
+        convert(reference, [(self.moth.pk, variant.pk, 1)])
+
+        variant.refresh_from_db()
+        self.assertEqual((variant.stock, variant.reserved), (0, 0))
+        self.assertEqual(self.state(self.moth), (3, 0))
+
+    def test_expired_holds_are_released_in_bulk(self):
+        for _ in range(3):
+            reserve([(self.moth.pk, None, 1)])
+        reserve([(self.heron.pk, None, 1)], minutes=60)
+        StockHold.objects.filter(product=self.moth).update(expires_at=timezone.now() - timedelta(hours=1))
+
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(release_expired(), 3)
+
+        self.assertEqual(self.state(self.moth), (3, 0))
+        self.assertEqual(self.state(self.heron), (1, 1))
+        updates = [q for q in ctx.captured_queries if q["sql"].startswith('UPDATE "shop_product"')]
+        self.assertEqual(len(updates), 1)
+
+    def test_saving_a_stale_product_keeps_reserved(self):
+        stale = Product.objects.get(pk=self.moth.pk)
+        reserve([(self.moth.pk, None, 2)])
+
+        stale.stock = 10
+        stale.save()
+
+        self.assertEqual(self.state(self.moth), (10, 2))
+
+
+class ConcurrentStockTests(ShopTransactionTestCase):
+    """Many buyers racing for a limited drop: never more holds or sales than stock."""
+
+    BUYERS = 60
+    STOCK = 15
+
+    def test_limited_drop_never_oversells(self):
+        product = Product.objects.create(
+            title="Moth (edition of 15)", category=Category.objects.create(name="Prints"),
+            price="40.00", stock=self.STOCK,
+        )
+
+        def checkout():
+            try:
+                return reserve([(product.pk, None, 1)])[0]
+            except OutOfStock:
+                return None
+
+        references, errors = race([checkout] * self.BUYERS)
+        self.assertEqual(errors, [])
+        held = [r for r in references if r]
+        self.assertEqual(len(held), self.STOCK)
+        product.refresh_from_db()
+        self.assertEqual((product.stock, product.reserved), (self.STOCK, self.STOCK))
+
+        # Every held checkout pays at once
+        def payment(reference):
+            def pay():
+                with transaction.atomic():
+                    return convert(reference, [(product.pk, None, 1)])
+            return pay
+
+        shortfalls, errors = race([payment(reference) for reference in held])
+        self.assertEqual(errors, [])
+        self.assertEqual([s for s in shortfalls if s], [])
+        product.refresh_from_db()
+        self.assertEqual((product.stock, product.reserved), (0, 0))
+        self.assertFalse(StockHold.objects.exists())
+
+
+# ============================
+# ORDER SNAPSHOTS
+# ============================
+class OrderSnapshotTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        category = Category.objects.create(name="Prints")
+        self.products = [
+            Product.objects.create(title=f"Print {n}", category=category, price="10.00") for n in range(5)
+        ]
+        self.order = Order.objects.create(email="buyer@example.com", total_price="50.00")
+        OrderItem.objects.bulk_create([
+            OrderItem(
+                order=self.order, product=product, quantity=1,
+                title=product.title, unit_price=Decimal("10.00"), line_total=Decimal("10.00"),
+            )
+            for product in self.products
+        ])
+        self.client.force_login(User.objects.create_user("staff", password="pw"))
+
+    def test_order_detail_renders_from_the_order_tables(self):
+        url = reverse("shop:order_detail", args=[self.order.pk])
+        self.client.get(url)  # warm session and template caches
+
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+
+        self.assertContains(response, "Print 4")
+        self.assertContains(response, "£10.00")
+        self.assertFalse([q for q in ctx.captured_queries if 'FROM "shop_product"' in q["sql"]])
+        item_queries = [q for q in ctx.captured_queries if 'FROM "shop_orderitem"' in q["sql"]]
+        self.assertEqual(len(item_queries), 1)
+
+    def test_deleting_products_keeps_order_history(self):
+        self.client.post(
+            reverse("shop:bulk_delete"), {"selected_products[]": [p.pk for p in self.products[:3]]},
+        )
+
+        items = self.order.items.order_by("pk")
+        self.assertEqual(items.count(), 5)
+        self.assertEqual([i.product_id is None for i in items], [True, True, True, False, False])
+        self.assertEqual(items[0].title, "Print 0")
+
+
+# ============================
+# ORDER MANAGEMENT LIST
+# ============================
+class ManageOrdersTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(User.objects.create_user("staff", password="pw", is_staff=True))
+        self.url = reverse("shop:manage_orders")
+
+    def make_orders(self, count, **fields):
+        buyers = [User.objects.create_user(f"buyer{n}-{Order.objects.count()}") for n in range(count)]
+        orders = [Order.objects.create(user=buyer, total_price="10.00", **fields) for buyer in buyers]
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, quantity=1, title="Print") for order in orders for _ in range(2)
+        ])
+        return orders
+
+    def listed(self, response):
+        return [order.pk for order in response.context["orders"]]
+
+    def test_customers_cannot_list_orders(self):
+        self.make_orders(1)
+        self.client.force_login(User.objects.create_user("buyer", password="pw"))
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertIsNone(response.context)
+
+    def test_queries_do_not_grow_with_the_page(self):
+        self.make_orders(3)
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(self.url)
+
+        self.make_orders(40)
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(self.url)
+
+        self.assertEqual(len(large), len(small))
+        self.assertEqual(len(response.context["orders"]), 43)
+        self.assertEqual({order.item_count for order in response.context["orders"]}, {2})
+        self.assertContains(response, response.context["orders"].object_list[0].user.username)
+
+    def test_keyset_pages_cover_every_order_once(self):
+        orders = self.make_orders(ORDERS_PER_PAGE + 5, status="shipped")
+
+        first = self.client.get(self.url, {"status": "shipped"})
+        self.assertTrue(first.context["page"].has_next)
+        second = self.client.get(f"{self.url}?{first.context['page'].next_query}")
+
+        seen = self.listed(first) + self.listed(second)
+        self.assertEqual(seen, sorted((o.pk for o in orders), reverse=True))
+        self.assertFalse(second.context["page"].has_next)
+        self.assertIn("status=shipped", second.context["page"].first_query)
+
+    def test_filters(self):
+        paid, shipped = self.make_orders(2)
+        Order.objects.filter(pk=shipped.pk).update(status="shipped", email="Buyer@Example.com")
+        Order.objects.filter(pk=paid.pk).update(created_at=timezone.now() - timedelta(days=40))
+        today = timezone.localdate()
+
+        self.assertEqual(self.listed(self.client.get(self.url, {"status": "shipped"})), [shipped.pk])
+        self.assertEqual(self.listed(self.client.get(self.url, {"email": "buyer@example.com"})), [shipped.pk])
+        self.assertEqual(
+            self.listed(self.client.get(self.url, {"date_from": today - timedelta(days=1), "date_to": today})),
+            [shipped.pk],
+        )
+        self.assertEqual(
+            self.listed(self.client.get(self.url, {"date_to": today - timedelta(days=30)})),
+            [paid.pk],
+        )
+
+    def test_invalid_filters_are_ignored(self):
+        self.make_orders(2)
+
+        response = self.client.get(self.url, {"date_from": "not-a-date", "status": "bogus"})
+
+        self.assertEqual(len(self.listed(response)), 2)
+        self.assertTrue(response.context["form"].errors)
+
+
+# ============================
+# ORDER EXPORT
+# ============================
+class OrderExportTests(ShopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(User.objects.create_user("staff", password="pw", is_staff=True))
+        self.url = reverse("shop:export_orders")
+        self.orders = []
+        for n in range(7):
+            order = Order.objects.create(
+                email=f"buyer{n}@example.com", total_price="35.00", shipping_name=f"Buyer {n}",
+                status="shipped" if n % 2 else "paid",
+            )
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, quantity=1, title="Moth, large", unit_price="10.00", line_total="10.00"),
+                OrderItem(order=order, quantity=1, title="Heron", variant_name="A3",
+                          unit_price="25.00", line_total="25.00"),
+            ])
+            self.orders.append(order)
+        # An order whose lines are missing still gets a row
+        self.orders.append(Order.objects.create(email="empty@example.com", total_price="0.00"))
+
+    def test_csv_streams_one_row_per_line(self):
+        response = self.client.get(self.url)
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertIn("attachment;", response["Content-Disposition"])
+        rows = list(csv.DictReader(StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual(len(rows), 7 * 2 + 1)
+        self.assertEqual([r["order_id"] for r in rows[:2]], [str(self.orders[0].pk)] * 2)
+        self.assertEqual((rows[0]["title"], rows[1]["variant_name"]), ("Moth, large", "A3"))
+        self.assertEqual((rows[-1]["email"], rows[-1]["title"]), ("empty@example.com", ""))
+
+    def test_ndjson_nests_lines_and_filters(self):
+        response = self.client.get(self.url, {"format": "ndjson", "status": "shipped"})
+
+        orders = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual([o["order_id"] for o in orders], [o.pk for o in self.orders if o.status == "shipped"])
+        self.assertEqual(orders[0]["items"][1], {
+            "title": "Heron", "variant_name": "A3", "quantity": 1, "unit_price": "25.00", "line_total": "25.00",
+        })
+
+    def test_customers_cannot_export(self):
+        self.client.force_login(User.objects.create_user("buyer", password="pw"))
+
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(response.streaming)
+
+    def test_bad_format_or_filter_is_rejected(self):
+        self.assertEqual(self.client.get(self.url, {"format": "xlsx"}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {"date_from": "soon"}).status_code, 400)
+
+    def test_reads_lazily_in_chunks(self):
+        with self.assertNumQueries(0):
+            lines = export_lines(Order.objects.all(), "csv", chunk_size=3)
+            next(lines)  # the header goes out before any query
+
+        with CaptureQueriesContext(connection) as ctx:
+            next(lines)
+        self.assertEqual(len(ctx), 2)  # the orders cursor and the first chunk's lines
+
+        with CaptureQueriesContext(connection) as ctx:
+            rest = list(lines)
+        self.assertEqual(len(rest), 7)
+        # Two more chunks of lines, one query each
+        self.assertEqual(len([q for q in ctx.captured_queries if 'FROM "shop_orderitem"' in q["sql"]]), 2)
+
+    def test_command_writes_the_same_export(self):
+        path = os.path.join(tempfile.mkdtemp(), "orders.ndjson")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        call_command("export_orders", "--format", "ndjson", "--status", "paid", "-o", path, stdout=StringIO())
+
+        with open(path, encoding="utf-8") as f:
+            exported = [json.loads(line)["order_id"] for line in f]
+        self.assertEqual(exported, [o.pk for o in self.orders if o.status == "paid"])
+
+        with self.assertRaises(CommandError):
+            call_command("export_orders", "--from", "yesterday")
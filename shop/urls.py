@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import api, views
 
 app_name = "shop"
 
@@ -16,6 +16,7 @@ urlpatterns = [
     path('manage/products/<int:pk>/duplicate/', views.duplicate_product, name='duplicate_product'),
         # Orders (admin)
     path('manage/orders/', views.manage_orders, name='manage_orders'),
+    path('manage/orders/export/', views.export_orders, name='export_orders'),
     path('manage/orders/<int:order_id>/', views.order_detail, name='order_detail'),
 
 
@@ -25,6 +26,9 @@ urlpatterns = [
     path('manage/images/<int:image_id>/delete/', views.delete_product_image, name='delete_product_image'),
     path('manage/images/reorder/', views.update_image_order, name='update_image_order'),
 
+    # Catalog cache counters (per worker)
+    path('manage/cache-stats/', views.catalog_cache_stats, name='catalog_cache_stats'),
+
     # Categories
     path('manage/categories/', views.manage_categories, name='manage_categories'),
     path('manage/categories/add/', views.add_category, name='add_category'),
@@ -46,6 +50,7 @@ path('webhooks/stripe/', views.stripe_webhook, name='stripe_webhook'),
 
 # Shop index / product list
 path('', views.product_list, name='shop_index'),
+path('search/', views.product_search, name='search'),
 
 # Add to cart
 path('add-to-cart/<int:product_id>/', views.add_to_cart, name='add_to_cart'),
@@ -56,6 +61,11 @@ path('remove-from-cart/<int:item_id>/', views.remove_from_cart, name='remove_fro
 path('update-cart-item/<int:item_id>/', views.update_cart_item, name='update_cart_item'),
 path('create-checkout-session/', views.create_checkout_session, name='create_checkout_session'),
 path('thank-you/', views.success, name='success'),
+
+# JSON cart API (the form views above stay as the no-JS fallback)
+path('api/cart/', api.cart_detail, name='api_cart'),
+path('api/cart/add/', api.cart_add, name='api_cart_add'),
+path('api/cart/batch/', api.cart_batch, name='api_cart_batch'),
 path('cancel/', views.cancel, name='cancel'),
 path("webhook/stripe/", views.stripe_webhook, name="stripe_webhook"),
 
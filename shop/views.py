@@ -1,16 +1,31 @@
+import json
+
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse, HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django.urls import reverse
+from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
-from django.contrib.auth import get_user_model
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
+from django.views.decorators.http import condition
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
 import stripe
 
-from config import settings
-from shop.forms import CategoryForm, ProductForm, VariantForm
+from django.conf import settings
+from accounts.decorators import staff_required
+from shop.exports import FORMATS, export_lines
+from shop.forms import CategoryForm, OrderFilterForm, ProductForm, VariantForm
+from shop.images import generate_derivatives
+from shop.outbox import enqueue_order_shipped
+from shop.cache import anonymous_page_cache, catalog_cache, page_is_cacheable
+from shop.cart import cart_changed, cart_lines, get_session_cart, save_session_cart
+from shop.pagination import KeysetPage, keyset_paginate, keyset_slice
+from shop.payments import idempotency_key, stripe_client
+from shop.search import search_products
+from shop.stock import OutOfStock, release, reserve
+from shop.webhooks import record_event
 
 from .models import (
     Product,
@@ -23,39 +38,87 @@ from .models import (
     OrderItem,
 )
 
+ORDERS_PER_PAGE = 50
+
 
 # ===========================================================
-# SESSION CART HELPERS (GUEST SUPPORT)
+# PUBLIC SHOP VIEWS
 # ===========================================================
 
-def save_session_cart(request, data):
-    request.session["cart"] = data
-    request.session.modified = True
+@anonymous_page_cache
+def product_list(request):
+    slug = request.GET.get("category", "")
+    cursor = request.GET.get("cursor", "")
+
+    def build():
+        category = None
+        products = Product.objects.for_cards()
+        if slug:
+            category = get_object_or_404(Category, slug=slug)
+            products = products.filter(category=category)
+        rows, next_cursor = keyset_slice(products, cursor)
+        return {"category": category, "rows": rows, "next_cursor": next_cursor}
+
+    data = catalog_cache.get_or_set(f"list:{slug}:{cursor}", build)
+    categories = catalog_cache.get_or_set("categories", lambda: list(Category.objects.all()))
+    page = KeysetPage(data["rows"], data["next_cursor"], request.GET)
+
+    return render(request, "shop/product_list.html", {
+        "products": page,
+        "page": page,
+        "categories": categories,
+        "category": data["category"],
+    })
 
 
-def get_session_cart(request):
-    return request.session.get("cart", {})
+def product_search(request):
+    query = request.GET.get("q", "").strip()
+    products = search_products(query) if query else []
 
+    return render(request, "shop/search.html", {
+        "query": query,
+        "products": products,
+    })
 
-# ===========================================================
-# PUBLIC SHOP VIEWS
-# ===========================================================
 
-def product_list(request):
-    products = Product.objects.all().order_by('-created_at')
-    return render(request, "shop/product_list.html", {"products": products})
+# Last-Modified never predates this process, so a deploy can't revalidate old HTML
+STARTED_AT = timezone.now().replace(microsecond=0)
 
 
+def product_validators(request, slug):
+    # The page also carries per-visitor parts (cart badge, login state,
+    # messages), so only the shared anonymous page may answer 304
+    if not page_is_cacheable(request):
+        return None
+    release = settings.PAGE_CACHE_PREFIX
+    return catalog_cache.get_or_set(
+        f"validators:{release}:{slug}",
+        lambda: Product.page_validators(slug, release=release, not_before=STARTED_AT),
+    )
+
+
+def product_etag(request, slug):
+    validators = product_validators(request, slug)
+    return validators and validators[0]
+
+
+def product_last_modified(request, slug):
+    validators = product_validators(request, slug)
+    return validators and validators[1]
+
+
+@condition(etag_func=product_etag, last_modified_func=product_last_modified)
+@anonymous_page_cache
 def product_detail(request, slug):
-    product = get_object_or_404(Product, slug=slug)
-    images = product.images.all()
-    variants = product.variants.all()
+    def build():
+        product = get_object_or_404(Product.objects.for_pages(), slug=slug)
+        return {
+            "product": product,
+            "images": list(product.images.all()),
+            "variants": list(product.variants.all()),
+        }
 
-    return render(request, "shop/product_detail.html", {
-        "product": product,
-        "images": images,
-        "variants": variants,
-    })
+    return render(request, "shop/product_detail.html", catalog_cache.get_or_set(f"detail:{slug}", build))
 
 
 # ===========================================================
@@ -68,13 +131,9 @@ def add_to_cart(request, product_id):
     # LOGGED-IN USER
     if request.user.is_authenticated:
         cart, _ = Cart.objects.get_or_create(user=request.user)
-        item = CartItem.objects.filter(cart=cart, product=product).first()
-
-        if item:
-            item.quantity += 1
-            item.save()
-        else:
-            CartItem.objects.create(cart=cart, product=product, quantity=1)
+        # Single upsert: concurrent double-clicks can't lose an increment
+        CartItem.objects.add(cart.id, product.id)
+        cart_changed(request.user)
 
         messages.success(request, f"{product.title} added to cart.")
         return redirect("shop:cart")
@@ -83,15 +142,7 @@ def add_to_cart(request, product_id):
     cart = get_session_cart(request)
 
     pid = str(product.id)
-
-    if pid in cart:
-        cart[pid]["quantity"] += 1
-    else:
-        cart[pid] = {
-            "title": product.title,
-            "price": float(product.price),
-            "quantity": 1,
-        }
+    cart[pid] = cart.get(pid, 0) + 1
 
     save_session_cart(request, cart)
     messages.success(request, f"{product.title} added to cart.")
@@ -107,7 +158,10 @@ def success(request):
     order = None
 
     if session_id:
-        order = Order.objects.filter(stripe_session_id=session_id).first()
+        order = Order.objects.prefetch_related("items").filter(stripe_session_id=session_id).first()
+        # Back from Stripe in the buyer's own browser: empty a guest cart here,
+        # the webhook never sees this session
+        save_session_cart(request, {})
 
     return render(request, "shop/success.html", {"order": order})
 
@@ -121,34 +175,9 @@ def cancel(request):
 # ===========================================================
 
 def cart_view(request):
-    # LOGGED-IN
-    if request.user.is_authenticated:
-        cart, _ = Cart.objects.get_or_create(user=request.user)
-        items = cart.items.all()
-        total = sum(item.total_price for item in items)
-
-        return render(request, "shop/cart.html", {
-            "cart": cart,
-            "items": items,
-            "total": total,
-        })
-
-    # GUEST
-    cart = get_session_cart(request)
-    items = []
-    total = 0
-
-    for pid, data in cart.items():
-        total += data["price"] * data["quantity"]
-        items.append({
-            "id": pid,
-            "title": data["title"],
-            "quantity": data["quantity"],
-            "total_price": data["price"] * data["quantity"],
-        })
+    items, total = cart_lines(request)
 
     return render(request, "shop/cart.html", {
-        "cart": cart,
         "items": items,
         "total": total,
     })
@@ -163,6 +192,7 @@ def remove_from_cart(request, item_id):
     if request.user.is_authenticated:
         item = get_object_or_404(CartItem, id=item_id, cart__user=request.user)
         item.delete()
+        cart_changed(request.user)
         messages.success(request, "Item removed.")
         return redirect("shop:cart")
 
@@ -193,6 +223,7 @@ def update_cart_item(request, item_id):
             item.save()
         else:
             item.delete()
+        cart_changed(request.user)
 
         return redirect("shop:cart")
 
@@ -203,7 +234,7 @@ def update_cart_item(request, item_id):
 
     if pid in cart:
         if qty > 0:
-            cart[pid]["quantity"] = qty
+            cart[pid] = qty
         else:
             del cart[pid]
 
@@ -219,62 +250,72 @@ def create_checkout_session(request):
     if request.method != "POST":
         return redirect("shop:cart")
 
-    stripe.api_key = settings.STRIPE_SECRET_KEY
-
     # GET ITEMS
-    if request.user.is_authenticated:
-        cart, _ = Cart.objects.get_or_create(user=request.user)
-        cart_items = cart.items.all()
-    else:
-        cart_items = request.session.get("cart", {})
-    
+    cart_items, _ = cart_lines(request)
+
     if not cart_items:
         messages.error(request, "Your cart is empty.")
         return redirect("shop:cart")
 
-    # BUILD LINE ITEMS
+    # BUILD LINE ITEMS (prices always from the product table; ids ride along
+    # in the metadata so the webhook never has to match on titles)
     line_items = []
+    for item in cart_items:
+        product_metadata = {"product_id": str(item.product.id)}
+        variant = getattr(item, "variant", None)
+        if variant is not None:
+            product_metadata["variant_id"] = str(variant.id)
+
+        line_items.append({
+            "price_data": {
+                "currency": "gbp",
+                "product_data": {"name": item.product.title, "metadata": product_metadata},
+                "unit_amount": int(item.product.price * 100),
+            },
+            "quantity": item.quantity,
+        })
 
-    if request.user.is_authenticated:
-        for item in cart_items:
-            line_items.append({
-                "price_data": {
-                    "currency": "gbp",
-                    "product_data": {"name": item.product.title},
-                    "unit_amount": int(item.product.price * 100),
-                },
-                "quantity": item.quantity,
-            })
-    else:
-        # SESSION CART
-        for pid, data in cart_items.items():
-            line_items.append({
-                "price_data": {
-                    "currency": "gbp",
-                    "product_data": {"name": data["title"]},
-                    "unit_amount": int(float(data["price"]) * 100),
-                },
-                "quantity": data["quantity"],
-            })
+    # HOLD STOCK until the session expires (or is paid)
+    try:
+        hold, hold_expires = reserve([
+            (item.product.id, getattr(getattr(item, "variant", None), "id", None), item.quantity)
+            for item in cart_items
+        ])
+    except OutOfStock as exc:
+        sold_out = {pid for pid, _ in exc.keys}
+        titles = ", ".join(item.product.title for item in cart_items if item.product.id in sold_out)
+        messages.error(request, f"Sorry, there isn't enough stock left for: {titles}.")
+        return redirect("shop:cart")
 
     # METADATA
-    metadata = {}
+    metadata = {"hold": hold}
     if request.user.is_authenticated:
         metadata["user_id"] = request.user.id
 
-    session = stripe.checkout.Session.create(
-        payment_method_types=["card"],
-        mode="payment",
-        line_items=line_items,
-        customer_email=request.user.email if request.user.is_authenticated else None,
-        billing_address_collection="required",
-        shipping_address_collection={"allowed_countries": ["GB"]},
-        metadata=metadata,
-        success_url=request.build_absolute_uri(
+    params = {
+        "payment_method_types": ["card"],
+        "mode": "payment",
+        "line_items": line_items,
+        "customer_email": (request.user.email or None) if request.user.is_authenticated else None,
+        "billing_address_collection": "required",
+        "shipping_address_collection": {"allowed_countries": ["GB"]},
+        "metadata": metadata,
+        "expires_at": int(hold_expires.timestamp()),
+        "success_url": request.build_absolute_uri(
             reverse("shop:success")
         ) + "?session_id={CHECKOUT_SESSION_ID}",
-        cancel_url=request.build_absolute_uri(reverse("shop:cancel")),
-    )
+        "cancel_url": request.build_absolute_uri(reverse("shop:cancel")),
+    }
+
+    try:
+        session = stripe_client().v1.checkout.sessions.create(
+            params=params,
+            options={"idempotency_key": idempotency_key("checkout")},
+        )
+    except stripe.StripeError:
+        release(hold)
+        messages.error(request, "We couldn't reach our payment provider. Please try again.")
+        return redirect("shop:cart")
 
     return redirect(session.url)
 
@@ -285,8 +326,20 @@ def create_checkout_session(request):
 
 @login_required
 def manage_products(request):
-    products = Product.objects.all().order_by('-created_at')
-    return render(request, "shop/manage/products_list.html", {"products": products})
+    categories = Category.objects.all()
+    products = Product.objects.for_cards()
+
+    category_id = request.GET.get("category")
+    if category_id and category_id.isdigit():
+        products = products.filter(category_id=category_id)
+
+    page = keyset_paginate(request, products)
+
+    return render(request, "shop/manage/products_list.html", {
+        "products": page,
+        "page": page,
+        "categories": categories,
+    })
 
 
 @login_required
@@ -336,7 +389,8 @@ def delete_product(request, pk):
 
 @login_required
 def bulk_delete(request):
-    ids = request.POST.getlist("ids")
+    # The manage grid posts selected_products[]; "ids" kept for older forms
+    ids = request.POST.getlist("selected_products[]") or request.POST.getlist("ids")
     Product.objects.filter(id__in=ids).delete()
     messages.success(request, "Products deleted.")
     return redirect("shop:manage_products")
@@ -345,9 +399,29 @@ def bulk_delete(request):
 @login_required
 def duplicate_product(request, pk):
     product = get_object_or_404(Product, pk=pk)
-    product.pk = None
-    product.slug = product.slug + "-copy"
-    product.save()
+    images = list(product.images.all())
+    variants = list(product.variants.all())
+
+    slug = base = product.slug + "-copy"
+    n = 2
+    while Product.objects.filter(slug=slug).exists():
+        slug = f"{base}-{n}"
+        n += 1
+
+    # Images are content-addressed, so the copy just points at the same files
+    with transaction.atomic():
+        product.pk = None
+        product.slug = slug
+        product.reserved = 0
+        product.save()
+        for obj in images + variants:
+            obj.pk = None
+            obj.product = product
+        for variant in variants:
+            variant.reserved = 0
+        ProductImage.objects.bulk_create(images)
+        ProductVariant.objects.bulk_create(variants)
+
     messages.success(request, "Product duplicated.")
     return redirect("shop:edit_product", pk=product.pk)
 
@@ -362,7 +436,8 @@ def upload_product_image(request, product_id):
 
     if request.method == "POST" and request.FILES.getlist("images"):
         for img in request.FILES.getlist("images"):
-            ProductImage.objects.create(product=product, image=img)
+            image = ProductImage.objects.create(product=product, image=img)
+            generate_derivatives(image)
         messages.success(request, "Images uploaded.")
     return redirect("shop:edit_product", pk=product_id)
 
@@ -380,11 +455,23 @@ def delete_product_image(request, image_id):
 def update_image_order(request):
     if request.method == "POST":
         order = request.POST.getlist("order[]")
+        now = timezone.now()
         for idx, image_id in enumerate(order):
-            ProductImage.objects.filter(id=image_id).update(position=idx)
+            ProductImage.objects.filter(id=image_id).update(position=idx, updated_at=now)
+        # .update() sends no signals, so invalidate the catalog cache here
+        catalog_cache.bump()
         return JsonResponse({"status": "success"})
 
 
+# ===========================================================
+# CATALOG CACHE STATS
+# ===========================================================
+
+@staff_required
+def catalog_cache_stats(request):
+    return JsonResponse(catalog_cache.snapshot())
+
+
 # ===========================================================
 # CATEGORY MANAGEMENT
 # ===========================================================
@@ -492,12 +579,13 @@ def delete_variant(request, variant_id):
 
 
 # ===========================================================
-# STRIPE WEBHOOK – FIXED + EMAIL + CLEAR SESSION CART
+# STRIPE WEBHOOK – VERIFY, STORE, RETURN
 # ===========================================================
+# Orders, emails and cart clearing happen in process_stripe_events (see
+# shop/webhooks.py), so Stripe gets its 200 before any of that can time out.
 
 @csrf_exempt
 def stripe_webhook(request):
-    stripe.api_key = settings.STRIPE_SECRET_KEY
     endpoint_secret = getattr(settings, "STRIPE_WEBHOOK_SECRET", None)
 
     payload = request.body
@@ -507,85 +595,11 @@ def stripe_webhook(request):
         return HttpResponse(status=200)
 
     try:
-        event = stripe.Webhook.construct_event(
-            payload=payload,
-            sig_header=sig_header,
-            secret=endpoint_secret,
-        )
-    except (ValueError, stripe.error.SignatureVerificationError):
+        stripe_client().construct_event(payload, sig_header, endpoint_secret)
+    except (ValueError, stripe.SignatureVerificationError):
         return HttpResponse(status=400)
 
-    if event["type"] == "checkout.session.completed":
-        session = event["data"]["object"]
-
-        # USER METADATA
-        User = get_user_model()
-        user = None
-        user_id = session.get("metadata", {}).get("user_id")
-
-        if user_id:
-            try:
-                user = User.objects.get(id=user_id)
-            except User.DoesNotExist:
-                user = None
-
-        # CUSTOMER INFO
-        total_price = (session.get("amount_total") or 0) / 100
-        customer_details = session.get("customer_details") or {}
-        collected_info = session.get("collected_information", {}) or {}
-        shipping_details = collected_info.get("shipping_details") or {}
-        address = shipping_details.get("address") or {}
-
-        # CREATE ORDER
-        order = Order.objects.create(
-            user=user,
-            email=customer_details.get("email"),
-            total_price=total_price,
-            stripe_session_id=session.get("id"),
-            stripe_payment_intent=session.get("payment_intent"),
-
-            shipping_name=shipping_details.get("name") or customer_details.get("name"),
-            shipping_address1=address.get("line1"),
-            shipping_address2=address.get("line2"),
-            shipping_city=address.get("city"),
-            shipping_postcode=address.get("postal_code"),
-            shipping_country=address.get("country"),
-        )
-
-        # CREATE ORDER ITEMS
-        line_items = stripe.checkout.Session.list_line_items(session["id"])
-        for li in line_items["data"]:
-            product = Product.objects.filter(title=li.get("description")).first()
-            if product:
-                OrderItem.objects.create(
-                    order=order,
-                    product=product,
-                    quantity=li.get("quantity", 1),
-                )
-
-        # SEND EMAIL
-        if order.email:
-            subject = "Your Piffy Studio Order Confirmation"
-            message = render_to_string("emails/order_confirmation.txt", {
-                "order": order,
-                "items": order.items.all(),
-            })
-            send_mail(
-                subject,
-                message,
-                settings.DEFAULT_FROM_EMAIL,
-                [order.email],
-                fail_silently=True,
-            )
-
-        # CLEAR DB CART
-        if user:
-            Cart.objects.filter(user=user).delete()
-
-        # CLEAR SESSION CART (GUEST)
-        request.session["cart"] = {}
-        request.session.modified = True
-
+    record_event(json.loads(payload))
     return HttpResponse(status=200)
 
 
@@ -593,21 +607,58 @@ def stripe_webhook(request):
 # ORDER MANAGEMENT
 # ===========================================================
 
-@login_required
+@staff_required
 def manage_orders(request):
-    orders = Order.objects.all().order_by("-created_at")
-    return render(request, "shop/manage/orders_list.html", {"orders": orders})
+    form = OrderFilterForm(request.GET)
+    # A correlated COUNT per row, evaluated only for the rows on this page;
+    # a JOIN + GROUP BY would aggregate every matching order before the LIMIT
+    item_count = (
+        OrderItem.objects.filter(order=OuterRef("pk"))
+        .order_by().values("order").annotate(n=Count("pk")).values("n")
+    )
+    orders = form.filter(
+        Order.objects.select_related("user").annotate(item_count=Coalesce(Subquery(item_count), 0))
+    )
+
+    page = keyset_paginate(request, orders, per_page=ORDERS_PER_PAGE)
+
+    return render(request, "shop/manage/orders_list.html", {
+        "orders": page,
+        "page": page,
+        "form": form,
+    })
+
+
+@staff_required
+def export_orders(request):
+    """Stream the filtered orders and their lines as CSV or NDJSON for fulfilment."""
+    export_format = request.GET.get("format", "csv")
+    form = OrderFilterForm(request.GET)
+    if export_format not in FORMATS or not form.is_valid():
+        return HttpResponseBadRequest("Unknown format or invalid filters.")
+
+    response = StreamingHttpResponse(
+        export_lines(form.filter(Order.objects.all()), export_format),
+        content_type=FORMATS[export_format],
+    )
+    filename = f"orders-{timezone.localtime():%Y%m%d-%H%M}.{export_format}"
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
 
 
 @login_required
 def order_detail(request, order_id):
-    order = get_object_or_404(Order, pk=order_id)
+    order = get_object_or_404(Order.objects.select_related("user").prefetch_related("items"), pk=order_id)
 
     if request.method == "POST":
         new_status = request.POST.get("status")
         if new_status in dict(Order.STATUS_CHOICES):
-            order.status = new_status
-            order.save()
+            with transaction.atomic():
+                shipped_now = new_status == "shipped" and order.status != "shipped"
+                order.status = new_status
+                order.save()
+                if shipped_now:
+                    enqueue_order_shipped(order)
             messages.success(request, "Order status updated.")
             return redirect("shop:order_detail", order_id=order.id)
 
@@ -0,0 +1,241 @@
+import logging
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+
+from .cart import cart_changed
+from .models import Cart, Order, OrderItem, Product, ProductVariant, StripeEvent
+from .outbox import enqueue_order_confirmation
+from .payments import stripe_client
+from .stock import convert, release
+
+logger = logging.getLogger(__name__)
+
+# ============================
+# STRIPE EVENT PROCESSING
+# ============================
+# The webhook view only verifies and stores events (record_event); the
+# process_stripe_events command runs everything else. Each event is handled
+# inside one transaction that holds its row lock and marks it processed, so
+# the order is written exactly once even with several workers running.
+# Failures roll back and wait BACKOFF_BASE * 2^n seconds before the next try
+# (capped at BACKOFF_MAX), which rides out a Stripe or database outage of
+# several hours. After MAX_ATTEMPTS the event is parked as failed until
+# requeue_failed (process_stripe_events --requeue-failed) puts it back.
+
+HANDLED_EVENTS = {"checkout.session.completed", "checkout.session.expired"}
+MAX_ATTEMPTS = 12
+BACKOFF_BASE = 30
+BACKOFF_MAX = 60 * 60
+
+
+def record_event(payload):
+    """Store a verified event body; a retry of a stored event is ignored."""
+    if payload.get("type") not in HANDLED_EVENTS:
+        return
+    # INSERT ... ON CONFLICT DO NOTHING on the unique event_id
+    StripeEvent.objects.bulk_create(
+        [StripeEvent(event_id=payload["id"], type=payload["type"], payload=payload)],
+        ignore_conflicts=True,
+    )
+
+
+def process_pending(limit=100):
+    """Handle up to limit due pending events, oldest first. Returns (processed, failed)."""
+    processed = failed = 0
+    due = (
+        StripeEvent.objects.filter(status=StripeEvent.PENDING, next_attempt_at__lte=timezone.now())
+        .order_by("next_attempt_at", "id")
+        .values_list("pk", flat=True)[:limit]
+    )
+    for pk in due:
+        try:
+            if process_event(pk):
+                processed += 1
+        except Exception as exc:
+            logger.exception("Stripe event %s failed", pk)
+            record_failure(pk, exc)
+            failed += 1
+    return processed, failed
+
+
+def process_event(pk):
+    with transaction.atomic():
+        event = (
+            StripeEvent.objects.select_for_update(skip_locked=True)
+            .filter(pk=pk, status=StripeEvent.PENDING)
+            .first()
+        )
+        if event is None:
+            # Another worker has it, or already finished it
+            return False
+
+        session = event.payload["data"]["object"]
+        if event.type == "checkout.session.completed":
+            fulfil_checkout(session)
+        elif event.type == "checkout.session.expired":
+            release(session_hold(session))
+
+        event.status = StripeEvent.PROCESSED
+        event.attempts += 1
+        event.processed_at = timezone.now()
+        event.last_error = ""
+        event.save(update_fields=["status", "attempts", "processed_at", "last_error"])
+    return True
+
+
+def backoff(attempts):
+    return timedelta(seconds=min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX))
+
+
+def record_failure(pk, exc):
+    with transaction.atomic():
+        event = StripeEvent.objects.select_for_update().get(pk=pk)
+        event.attempts += 1
+        event.last_error = f"{type(exc).__name__}: {exc}"
+        if event.attempts >= MAX_ATTEMPTS:
+            event.status = StripeEvent.FAILED
+            logger.error("Giving up on Stripe event %s: %s", event.event_id, event.last_error)
+        else:
+            event.next_attempt_at = timezone.now() + backoff(event.attempts)
+        event.save(update_fields=["status", "attempts", "last_error", "next_attempt_at"])
+
+
+def requeue_failed(event_ids=None):
+    """Put failed events (all, or those in event_ids) back in the queue, due now. Returns how many."""
+    events = StripeEvent.objects.filter(status=StripeEvent.FAILED)
+    if event_ids:
+        events = events.filter(event_id__in=event_ids)
+    return events.update(status=StripeEvent.PENDING, attempts=0, next_attempt_at=timezone.now())
+
+
+# ============================
+# CHECKOUT COMPLETED
+# ============================
+
+def session_hold(session):
+    return (session.get("metadata") or {}).get("hold")
+
+
+def fulfil_checkout(session):
+    """Create the order for a completed Checkout Session and clear the buyer's cart."""
+    if Order.objects.filter(stripe_session_id=session["id"]).exists():
+        return None
+
+    # USER METADATA
+    user = None
+    user_id = (session.get("metadata") or {}).get("user_id")
+    if user_id:
+        user = get_user_model().objects.filter(id=user_id).first()
+
+    # CUSTOMER INFO
+    total_price = (session.get("amount_total") or 0) / 100
+    customer_details = session.get("customer_details") or {}
+    collected_info = session.get("collected_information") or {}
+    shipping_details = collected_info.get("shipping_details") or {}
+    address = shipping_details.get("address") or {}
+
+    order = Order.objects.create(
+        user=user,
+        email=customer_details.get("email"),
+        total_price=total_price,
+        stripe_session_id=session["id"],
+        stripe_payment_intent=session.get("payment_intent"),
+
+        shipping_name=shipping_details.get("name") or customer_details.get("name"),
+        shipping_address1=address.get("line1"),
+        shipping_address2=address.get("line2"),
+        shipping_city=address.get("city"),
+        shipping_postcode=address.get("postal_code"),
+        shipping_country=address.get("country"),
+    )
+
+    # ORDER ITEMS
+    items = OrderItem.objects.bulk_create(build_order_items(order, session["id"]))
+
+    # STOCK: the checkout's holds become sales
+    sold = [(i.product_id, i.variant_id, i.quantity) for i in items if i.product_id]
+    short = convert(session_hold(session), sold)
+    if short:
+        logger.error("Order %s paid after its hold lapsed and stock ran out: %s", order.pk, short)
+
+    # CLEAR DB CART
+    if user:
+        Cart.objects.filter(user=user).delete()
+        cart_changed(user)
+
+    # EMAIL: queued in this transaction, sent by send_outbox
+    enqueue_order_confirmation(order)
+    return order
+
+
+def fetch_line_items(session_id):
+    """Every line of a Checkout Session, with each price's product (and its metadata) expanded."""
+    line_items = stripe_client().v1.checkout.sessions.line_items.list(
+        session_id, params={"limit": 100, "expand": ["data.price.product"]},
+    )
+    return list(line_items.auto_paging_iter())
+
+
+def pence(amount):
+    """Stripe's integer minor units as pounds, or None when absent."""
+    return None if amount is None else Decimal(amount) / 100
+
+
+def line_item_ids(li):
+    """(product_id, variant_id) from the metadata set by create_checkout_session."""
+    product = (li.get("price") or {}).get("product")
+    metadata = (product.get("metadata") if isinstance(product, dict) else None) or {}
+    product_id = metadata.get("product_id")
+    variant_id = metadata.get("variant_id")
+    return (
+        int(product_id) if str(product_id).isdigit() else None,
+        int(variant_id) if str(variant_id).isdigit() else None,
+    )
+
+
+def build_order_items(order, session_id):
+    """Unsaved OrderItems for a session, resolved with one in_bulk per model."""
+    lines = [(li, *line_item_ids(li)) for li in fetch_line_items(session_id)]
+
+    products = Product.objects.in_bulk({pid for _, pid, _ in lines if pid})
+    variant_ids = {vid for _, _, vid in lines if vid}
+    variants = ProductVariant.objects.in_bulk(variant_ids) if variant_ids else {}
+
+    # Sessions created before ids were sent only carry the product title
+    untagged = {li.get("description") for li, pid, _ in lines if not pid}
+    by_title = {}
+    if untagged:
+        for product in Product.objects.filter(title__in=untagged).order_by("-pk"):
+            by_title[product.title] = product
+
+    items = []
+    for li, pid, vid in lines:
+        product = products.get(pid) if pid else by_title.get(li.get("description"))
+        if product is None:
+            # Still paid for, so it's recorded from what Stripe has
+            logger.warning("Order %s: no product for line item %s", order.pk, li.get("id"))
+        variant = variants.get(vid)
+        if variant and (product is None or variant.product_id != product.pk):
+            variant = None
+        quantity = li.get("quantity") or 1
+        unit_price = pence((li.get("price") or {}).get("unit_amount"))
+        if unit_price is None:
+            unit_price = product.price if product else Decimal("0")
+            if variant:
+                unit_price += variant.price_adjust
+        line_total = pence(li.get("amount_total"))
+        items.append(OrderItem(
+            order=order,
+            product=product,
+            variant=variant,
+            quantity=quantity,
+            title=product.title if product else (li.get("description") or ""),
+            variant_name=variant.name if variant else "",
+            unit_price=unit_price,
+            line_total=unit_price * quantity if line_total is None else line_total,
+        ))
+    return items
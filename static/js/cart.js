@@ -0,0 +1,98 @@
+// Cart page: send quantity changes and removals to the JSON cart API in one
+// batched request instead of a form post + redirect per change. Without JS
+// the forms and links in cart.html still work.
+
+document.addEventListener("DOMContentLoaded", function () {
+    const table = document.getElementById("cart-table");
+
+    if (!table) return;
+
+    const batchUrl = table.dataset.batchUrl;
+    const pending = new Map();
+    let timer = null;
+
+    function queue(productId, quantity) {
+        pending.set(productId, quantity);
+        clearTimeout(timer);
+        timer = setTimeout(flush, 300);
+    }
+
+    function flush() {
+        if (pending.size === 0) return;
+
+        const lines = Array.from(pending, ([product_id, quantity]) => ({ product_id, quantity }));
+        pending.clear();
+
+        fetch(batchUrl, {
+            method: "POST",
+            headers: {
+                "Content-Type": "application/json",
+                "X-CSRFToken": getCookie("csrftoken") || csrfFromForm(),
+            },
+            body: JSON.stringify({ lines: lines }),
+        })
+            .then((response) => (response.ok ? response.json() : Promise.reject(response)))
+            .then(render)
+            .catch(() => window.location.reload());
+    }
+
+    function render(cart) {
+        const byId = new Map(cart.lines.map((line) => [String(line.product_id), line]));
+
+        table.querySelectorAll("tbody tr").forEach((row) => {
+            const line = byId.get(row.dataset.productId);
+            if (!line) {
+                row.remove();
+                return;
+            }
+            row.querySelector(".line-total").textContent = "£" + line.line_total;
+        });
+
+        document.getElementById("cart-total").textContent = cart.total;
+
+        const badge = document.getElementById("cart-count");
+        if (badge) {
+            badge.textContent = cart.count;
+            badge.hidden = cart.count === 0;
+        }
+        if (cart.lines.length === 0) window.location.reload();
+    }
+
+    table.querySelectorAll("tbody tr").forEach((row) => {
+        const input = row.querySelector("input[name=quantity]");
+        const remove = row.querySelector(".cart-remove");
+
+        input.removeAttribute("onchange");
+        input.addEventListener("change", () => {
+            const quantity = Math.max(parseInt(input.value, 10) || 0, 0);
+            queue(row.dataset.productId, quantity);
+        });
+        row.querySelector(".cart-qty-form").addEventListener("submit", (event) => event.preventDefault());
+
+        remove.addEventListener("click", (event) => {
+            event.preventDefault();
+            queue(row.dataset.productId, 0);
+        });
+    });
+
+    // Simple cookie getter for CSRF
+    function getCookie(name) {
+        let cookieValue = null;
+        if (document.cookie && document.cookie !== "") {
+            const cookies = document.cookie.split(";");
+            for (let cookie of cookies) {
+                cookie = cookie.trim();
+                if (cookie.startsWith(name + "=")) {
+                    cookieValue = decodeURIComponent(cookie.substring(name.length + 1));
+                    break;
+                }
+            }
+        }
+        return cookieValue;
+    }
+
+    function csrfFromForm() {
+        const field = document.querySelector("input[name=csrfmiddlewaretoken]");
+        return field ? field.value : "";
+    }
+});